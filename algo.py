@@ -1,19 +1,52 @@
 from datetime import date
-from typing import Union, List
+from typing import Union
 import pandas as pd
 from config import DATA_DIR
-from data import StockData
+from data import StockData, ma_column, to_arrays
+import engine
 import os
+import numpy as np
+from price_cache import price_cache
+from events import event_index
+
+MA_WINDOW = 200
+
 
 class Price:
-    def __init__(self, _date: Union[str, date], _open: float, close: float, low: float, high: float, volume:float, ma: float):
-        self.date = date.fromisoformat(_date) if type(_date) == 'str' else _date
-        self.open = _open
-        self.close = close
-        self.low = low
-        self.high = high
-        self.volume = volume
-        self.ma = ma
+    """View of one bar of a PriceSeries. Values are read from the series arrays on access."""
+    __slots__ = ('_series', '_i')
+
+    def __init__(self, series: 'PriceSeries', i: int):
+        self._series = series
+        self._i = i
+
+    @property
+    def date(self) -> date:
+        return self._series.dates[self._i].astype(object)
+
+    @property
+    def open(self):
+        return self._series.open[self._i]
+
+    @property
+    def close(self):
+        return self._series.close[self._i]
+
+    @property
+    def low(self):
+        return self._series.low[self._i]
+
+    @property
+    def high(self):
+        return self._series.high[self._i]
+
+    @property
+    def volume(self):
+        return self._series.volume[self._i]
+
+    @property
+    def ma(self):
+        return self._series.ma[self._i]
 
     @property
     def is_green(self):
@@ -27,51 +60,104 @@ class Price:
         return f"< Date {self.date} | Open {self.open} | Close {self.close} >"
 
 
-def get_daily_price(stock: str, days: int) -> List[Price]:
-    data = StockData(stock).load()
+class PriceSeries:
+    """Daily bars of one stock held as contiguous arrays; indexing returns Price views."""
+    __slots__ = ('dates', 'open', 'close', 'low', 'high', 'volume', 'ma')
+
+    def __init__(self, dates, _open, close, low, high, volume, ma):
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.open = np.asarray(_open, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+        self.ma = np.asarray(ma, dtype=np.float64)
+
+    @classmethod
+    def empty(cls):
+        return cls(*([] for _ in range(7)))
+
+    @classmethod
+    def from_arrays(cls, data: dict):
+        return cls(data['Date'], data['Open'], data['Close'], data['Low'], data['High'], data['Volume'], data['MA'])
+
+    @property
+    def is_green(self) -> np.ndarray:
+        return self.close > self.open
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, i: int) -> Price:
+        n = len(self.dates)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("PriceSeries index out of range")
+        return Price(self, i)
+
+    def __iter__(self):
+        return (Price(self, i) for i in range(len(self.dates)))
+
+    def __str__(self):
+        return f"< PriceSeries | Bars {len(self)} >"
+
+
+def get_stock_arrays(stock: str) -> Union[dict, None]:
+    """
+    Full stored history of a stock as a dict of arrays ('Date', 'Open', 'High', 'Low', 'Close', 'MA').
+    Served from the shared price cache when the stock is in the current snapshot.
+    """
+    data = price_cache.get(stock)
     if data is None:
-        return []
-
-    # Read extra data to ensure we have enough for MA calculation
-    # We need at least 200 days + the requested days
-    required_data_points = days + 200
-
-    if len(data) < required_data_points:
-        # If we don't have enough data, use all available data
-        data_for_ma = data
-    else:
-        # Take the most recent required_data_points
-        data_for_ma = data.tail(required_data_points)
-
-    # Calculate 200-day moving average
-    data_for_ma['MA'] = data_for_ma['Close'].rolling(200).mean().round(2)
-
-    # Remove rows where MA is NaN (first 199 rows)
-    data_with_ma = data_for_ma.dropna(subset=['MA'])
-
-    # Take the last 'days' rows that have valid MA
-    final_data = data_with_ma.tail(days)
-
-    clean_data = []
-    for idx, row in final_data.iterrows():
-        clean_data.append(
-            Price(
-                _date=idx.date(),
-                _open=row['Open'],
-                close=row['Close'],
-                low=row['Low'],
-                high=row['High'],
-                volume=row['Volume'],
-                ma=row['MA'],
-            )
-        )
-    return clean_data
+        df = StockData(stock).load()
+        if df is None:
+            return None
+        data = to_arrays(df)
+    data['MA'] = data.pop(ma_column(MA_WINDOW))
+    return data
+
+
+def window_start(ma: np.ndarray, days: int) -> int:
+    """Index of the first of the last `days` bars with a valid MA (len(ma) if there are none)."""
+    # MA is NaN only for the bars before the first full window
+    valid = np.flatnonzero(~np.isnan(ma))
+    if not len(valid) or days <= 0:
+        return len(ma)
+    return int(max(valid[0], len(ma) - days))
+
+
+def get_daily_arrays(stock: str, days: int) -> Union[dict, None]:
+    """The last `days` bars of a stock that have a valid 200-day MA, as a dict of arrays."""
+    data = get_stock_arrays(stock)
+    if data is None:
+        return None
+    start = window_start(data['MA'], days)
+    return {col: values[start:] for col, values in data.items()}
+
+
+def data_version(stock: str):
+    """Token identifying the data get_daily_arrays would read for `stock`."""
+    return price_cache.version_of(stock) or StockData(stock).version()
+
+
+def get_daily_price(stock: str, days: int) -> PriceSeries:
+    data = get_daily_arrays(stock, days)
+    if data is None:
+        return PriceSeries.empty()
+    return PriceSeries.from_arrays(data)
 
 
 class Algo:
-    def __init__(self, stock: str, history: int, margin: int = 20, filter_by_last_close: bool = True, last_close_margin: int = 5):
+    BACKENDS = ('events', 'numpy', 'python')
+
+    def __init__(self, stock: str, history: int, margin: int = 20, filter_by_last_close: bool = True, last_close_margin: int = 5, backend: str = 'events'):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {self.BACKENDS}")
         self.stock = stock
-        self.prices = get_daily_price(stock, history)
+        self.history = history
+        self.backend = backend
+        self.prices = get_daily_price(stock, history) if backend == 'python' else PriceSeries.empty()
         self.n = len(self.prices)
         self.margin = margin
         self.filter_by_last_close = filter_by_last_close
@@ -125,7 +211,38 @@ class Algo:
             })
         return end + 1
 
+    def _run_numpy(self):
+        data = get_daily_arrays(self.stock, self.history)
+        if data is None:
+            return self.ans
+        self.ans = engine.scan(
+            self.stock,
+            data['Date'],
+            data['Open'],
+            data['Close'],
+            data['Low'],
+            data['High'],
+            data['MA'],
+            self.margin,
+            self.filter_by_last_close,
+            self.last_close_margin,
+        )
+        return self.ans
+
+    def _run_events(self):
+        data = get_stock_arrays(self.stock)
+        if data is None:
+            return self.ans
+        index = event_index(self.stock, data, data_version(self.stock))
+        self.ans = index.scan(self.stock, data, window_start(data['MA'], self.history), self.margin,
+                              self.filter_by_last_close, self.last_close_margin)
+        return self.ans
+
     def run_algo(self):
+        if self.backend == 'events':
+            return self._run_events()
+        if self.backend == 'numpy':
+            return self._run_numpy()
         start = 1
         while start < self.n:
             if self.prices[start].is_green:
@@ -10,6 +10,13 @@ import datetime, time
 import logging
 import re
 import urllib.parse
+import io
+from concurrent.futures import ThreadPoolExecutor
+from config import NSE_HISTORY_WORKERS
+from rate_limit import nse_limiter
+from nse_client import nse_client
+
+HISTORY_WINDOW_DAYS = 40  # Longest date range NSE serves in one historical request
 
 api_logger = logging.getLogger("api")
 api_logger.setLevel(logging.CRITICAL)
@@ -24,35 +31,26 @@ if (mode == 'vpn'):
             encoded_url = urllib.parse.quote(payload, safe=':/?&=')
         payload_var = 'curl -b cookies.txt "' + encoded_url + '"' + curl_headers + ''
         try:
+            nse_limiter.acquire()
             output = os.popen(payload_var).read()
             output = json.loads(output)
         except ValueError:  # includes simplejson.decoder.JSONDecodeError:
             payload2 = "https://www.nseindia.com"
+            nse_limiter.acquire()
             output2 = os.popen('curl -c cookies.txt "' + payload2 + '"' + curl_headers + '').read()
 
+            nse_limiter.acquire()
             output = os.popen(payload_var).read()
             output = json.loads(output)
         return output
 if (mode == 'local'):
     def nsefetch(payload):
-        headers = {
-            "User-Agent": "Mozilla/5.0",
-            "Accept": "*/*",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Referer": "https://www.nseindia.com",
-            "Connection": "keep-alive",
-        }
-        try:
-            output = requests.get(payload, headers=headers, timeout=20, verify=False).json()
-            # print(output)
-        except ValueError:
-            session = requests.Session()
-            session.headers.update(headers)
-
-            session.get("https://www.nseindia.com/option-chain", timeout=20, verify=False)
-            response = session.get(payload, timeout=20, verify=False)
-            output = response.json()
-        return output
+        return nse_client.get_json(payload)
+
+
+def nse_csv(url, **kwargs):
+    """Read a CSV file from the NSE archives through the pooled client."""
+    return pd.read_csv(io.StringIO(nse_client.get_text(url)), **kwargs)
 
 # headers = {
 #     'Connection': 'keep-alive',
@@ -544,7 +542,7 @@ def nse_get_fno_lot_sizes(symbol="all", mode="list"):
     url = "https://archives.nseindia.com/content/fo/fo_mktlots.csv"
 
     if (mode == "list"):
-        s = requests.get(url).text
+        s = nse_client.get_text(url)
         res_dict = {}
         for line in s.split('\n'):
             if line != '' and re.search(',', line) and (line.casefold().find('symbol') == -1):
@@ -556,7 +554,7 @@ def nse_get_fno_lot_sizes(symbol="all", mode="list"):
             return res_dict[symbol.upper()]
 
     if (mode == "pandas"):
-        payload = pd.read_csv(url)
+        payload = nse_csv(url)
         if (symbol == "all"):
             return payload
         else:
@@ -618,69 +616,60 @@ def black_scholes_dexter(S0, X, t, σ="", r=10, q=0.0, td=365):
 
 
 def equity_history_virgin(symbol, series, start_date, end_date):
+    return pd.DataFrame.from_records(_equity_history_records(symbol, series, start_date, end_date))
+
+
+def _equity_history_records(symbol, series, start_date, end_date):
     # url="https://www.nseindia.com/api/historical/cm/equity?symbol="+symbol+"&series=[%22"+series+"%22]&from="+str(start_date)+"&to="+str(end_date)+""
     # Use nsesymbolpurify to handle symbols with special characters like &
     symbol = nsesymbolpurify(symbol)
     url = 'https://www.nseindia.com/api/historical/cm/equity?symbol=' + symbol + '&series=["' + series + '"]&from=' + start_date + '&to=' + end_date
 
     payload = nsefetch(url)
-    return pd.DataFrame.from_records(payload["data"])
+    return payload["data"]
+
+
+def history_windows(start_date, end_date, days=HISTORY_WINDOW_DAYS):
+    """Consecutive, non-overlapping (from, to) windows of at most `days` days covering the dd-mm-yyyy range."""
+    start = datetime.datetime.strptime(start_date, "%d-%m-%Y").date()
+    end = datetime.datetime.strptime(end_date, "%d-%m-%Y").date()
+    windows = []
+    while True:
+        window_end = min(start + datetime.timedelta(days=days - 1), end)
+        windows.append((start.strftime("%d-%m-%Y"), window_end.strftime("%d-%m-%Y")))
+        if window_end >= end:
+            return windows
+        start = window_end + datetime.timedelta(days=1)
+
+
+def windowed_history(fetch_records, start_date, end_date):
+    """
+    Fetch a dd-mm-yyyy date range as windows of HISTORY_WINDOW_DAYS with `fetch_records(from, to)`,
+    NSE_HISTORY_WORKERS at a time under the NSE rate limit, and build one DataFrame from all the records.
+    NSE returns each window newest first; the rows are put oldest first.
+    """
+    windows = history_windows(start_date, end_date)
+    api_logger.info("Windows: " + str(len(windows)))
+    with ThreadPoolExecutor(max_workers=max(1, min(NSE_HISTORY_WORKERS, len(windows)))) as pool:
+        chunks = list(pool.map(lambda window: fetch_records(*window), windows))
+    records = [record for chunk in chunks for record in reversed(chunk)]
+    api_logger.info("Length of the Total Dataset: " + str(len(records)))
+    return pd.DataFrame.from_records(records)
 
 
 # You shall see beautiful use the logger function.
 def equity_history(symbol, series, start_date, end_date):
-    # We are getting the input in text. So it is being converted to Datetime object from String.
-    start_date = datetime.datetime.strptime(start_date, "%d-%m-%Y")
-    end_date = datetime.datetime.strptime(end_date, "%d-%m-%Y")
-    api_logger.info("Starting Date: " + str(start_date))
-    api_logger.info("Ending Date: " + str(end_date))
-
-    # We are calculating the difference between the days
-    diff = end_date - start_date
-    api_logger.info("Total Number of Days: " + str(diff.days))
-    api_logger.info("Total FOR Loops in the program: " + str(int(diff.days / 40)))
-    api_logger.info("Remainder Loop: " + str(diff.days - (int(diff.days / 40) * 40)))
-
-    total = pd.DataFrame()
-    for i in range(0, int(diff.days / 40)):
-        temp_date = (start_date + datetime.timedelta(days=(40))).strftime("%d-%m-%Y")
-        start_date = datetime.datetime.strftime(start_date, "%d-%m-%Y")
-
-        api_logger.info("Loop = " + str(i))
-        api_logger.info("====")
-        api_logger.info("Starting Date: " + str(start_date))
-        api_logger.info("Ending Date: " + str(temp_date))
-        api_logger.info("====")
-
-        # total=total.append(equity_history_virgin(symbol,series,start_date,temp_date))
-        # total=total.concat(equity_history_virgin(symbol,series,start_date,temp_date))
-        total = pd.concat([total, equity_history_virgin(symbol, series, start_date, temp_date)])
-
-        api_logger.info("Length of the Table: " + str(len(total)))
-
-        # Preparation for the next loop
-        start_date = datetime.datetime.strptime(temp_date, "%d-%m-%Y")
-
-    start_date = datetime.datetime.strftime(start_date, "%d-%m-%Y")
-    end_date = datetime.datetime.strftime(end_date, "%d-%m-%Y")
-
-    api_logger.info("End Loop")
-    api_logger.info("====")
-    api_logger.info("Starting Date: " + str(start_date))
-    api_logger.info("Ending Date: " + str(end_date))
-    api_logger.info("====")
-
-    # total=total.append(equity_history_virgin(symbol,series,start_date,end_date))
-    # total=total.concat(equity_history_virgin(symbol,series,start_date,end_date))
-    total = pd.concat([total, equity_history_virgin(symbol, series, start_date, end_date)])
-
-    api_logger.info("Finale")
-    api_logger.info("Length of the Total Dataset: " + str(len(total)))
-    payload = total.iloc[::-1].reset_index(drop=True)
-    return payload
+    return windowed_history(lambda start, end: _equity_history_records(symbol, series, start, end),
+                            start_date, end_date)
 
 
 def derivative_history_virgin(symbol, start_date, end_date, instrumentType, expiry_date, strikePrice="", optionType=""):
+    return pd.DataFrame.from_records(_derivative_history_records(symbol, start_date, end_date, instrumentType,
+                                                                 expiry_date, strikePrice, optionType))
+
+
+def _derivative_history_records(symbol, start_date, end_date, instrumentType, expiry_date, strikePrice="",
+                                optionType=""):
     instrumentType = instrumentType.lower()
 
     if (instrumentType == "options"):
@@ -701,62 +690,13 @@ def derivative_history_virgin(symbol, start_date, end_date, instrumentType, expi
     payload = nsefetch(nsefetch_url)
     api_logger.info(nsefetch_url)
     api_logger.info(payload)
-    return pd.DataFrame.from_records(payload["data"])
+    return payload["data"]
 
 
 def derivative_history(symbol, start_date, end_date, instrumentType, expiry_date, strikePrice="", optionType=""):
-    # We are getting the input in text. So it is being converted to Datetime object from String.
-    start_date = datetime.datetime.strptime(start_date, "%d-%m-%Y")
-    end_date = datetime.datetime.strptime(end_date, "%d-%m-%Y")
-    api_logger.info("Starting Date: " + str(start_date))
-    api_logger.info("Ending Date: " + str(end_date))
-
-    # We are calculating the difference between the days
-    diff = end_date - start_date
-    api_logger.info("Total Number of Days: " + str(diff.days))
-    api_logger.info("Total FOR Loops in the program: " + str(int(diff.days / 40)))
-    api_logger.info("Remainder Loop: " + str(diff.days - (int(diff.days / 40) * 40)))
-
-    total = pd.DataFrame()
-    for i in range(0, int(diff.days / 40)):
-        temp_date = (start_date + datetime.timedelta(days=(40))).strftime("%d-%m-%Y")
-        start_date = datetime.datetime.strftime(start_date, "%d-%m-%Y")
-
-        api_logger.info("Loop = " + str(i))
-        api_logger.info("====")
-        api_logger.info("Starting Date: " + str(start_date))
-        api_logger.info("Ending Date: " + str(temp_date))
-        api_logger.info("====")
-
-        # total=total.append(derivative_history_virgin(symbol,start_date,temp_date,instrumentType,expiry_date,strikePrice,optionType))
-        # total=total.concat([total, derivative_history_virgin(symbol,start_date,temp_date,instrumentType,expiry_date,strikePrice,optionType)])
-        total = pd.concat([total, derivative_history_virgin(symbol, start_date, temp_date, instrumentType, expiry_date,
-                                                            strikePrice, optionType)])
-
-        api_logger.info("Length of the Table: " + str(len(total)))
-
-        # Preparation for the next loop
-        start_date = datetime.datetime.strptime(temp_date, "%d-%m-%Y")
-
-    start_date = datetime.datetime.strftime(start_date, "%d-%m-%Y")
-    end_date = datetime.datetime.strftime(end_date, "%d-%m-%Y")
-
-    api_logger.info("End Loop")
-    api_logger.info("====")
-    api_logger.info("Starting Date: " + str(start_date))
-    api_logger.info("Ending Date: " + str(end_date))
-    api_logger.info("====")
-
-    # total=total.append(derivative_history_virgin(symbol,start_date,end_date,instrumentType,expiry_date,strikePrice,optionType))
-    # total = total.concat([total, derivative_history_virgin(symbol,start_date,end_date,instrumentType,expiry_date,strikePrice,optionType)])
-    total = pd.concat([total,
-                       derivative_history_virgin(symbol, start_date, end_date, instrumentType, expiry_date, strikePrice,
-                                                 optionType)])
-
-    api_logger.info("Finale")
-    api_logger.info("Length of the Total Dataset: " + str(len(total)))
-    payload = total.iloc[::-1].reset_index(drop=True)
-    return payload
+    return windowed_history(lambda start, end: _derivative_history_records(symbol, start, end, instrumentType,
+                                                                           expiry_date, strikePrice, optionType),
+                            start_date, end_date)
 
 
 def expiry_history(symbol, start_date="", end_date="", type="options"):
@@ -848,17 +788,17 @@ def index_total_returns(symbol, start_date, end_date):
 
 def get_bhavcopy(date):
     date = date.replace("-", "")
-    payload = pd.read_csv("https://archives.nseindia.com/products/content/sec_bhavdata_full_" + date + ".csv")
+    payload = nse_csv("https://archives.nseindia.com/products/content/sec_bhavdata_full_" + date + ".csv")
     return payload
 
 
 def get_bulkdeals():
-    payload = pd.read_csv("https://archives.nseindia.com/content/equities/bulk.csv")
+    payload = nse_csv("https://archives.nseindia.com/content/equities/bulk.csv")
     return payload
 
 
 def get_blockdeals():
-    payload = pd.read_csv("https://archives.nseindia.com/content/equities/block.csv")
+    payload = nse_csv("https://archives.nseindia.com/content/equities/block.csv")
     return payload
 
 
@@ -946,7 +886,7 @@ def nse_most_active(type="securities", sort="value"):
 
 def nse_eq_symbols():
     # https://forum.unofficed.com/t/feature-request-stocklist-api/1073/11
-    eq_list_pd = pd.read_csv('https://archives.nseindia.com/content/equities/EQUITY_L.csv')
+    eq_list_pd = nse_csv('https://archives.nseindia.com/content/equities/EQUITY_L.csv')
     return eq_list_pd['SYMBOL'].tolist()
 
 
@@ -986,7 +926,7 @@ def nse_largedeals_historical(from_date, to_date, mode="bulk_deals"):
 # print(get_fao_participant_oi("04-06-2021"))
 def get_fao_participant_oi(date):
     date = date.replace("-", "")
-    payload = pd.read_csv("https://archives.nseindia.com/content/nsccl/fao_participant_oi_" + date + ".csv")
+    payload = nse_csv("https://archives.nseindia.com/content/nsccl/fao_participant_oi_" + date + ".csv")
     return payload
 
 
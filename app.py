@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
-from flask import Flask
-from flask import render_template, request, redirect, url_for
-from algo import Algo
+import json
+import math
+import time
+from flask import Flask, Response, stream_with_context
+from flask import render_template, request, redirect, url_for, jsonify
+from scanner import scan_universe, iter_universe
 from config import STOCKS_FILE
+from result_cache import result_cache
+from result_query import paginate, parse_sort, fingerprint, DEFAULT_LIMIT
 
 app = Flask(__name__)
 
@@ -26,6 +31,30 @@ def stock():
     return render_template("stocks.html", stocks="\n".join(stocks))
 
 
+def scan_params(values):
+    """(history, margin, filter_by_last_close, last_close_margin) from the runAlgo form fields."""
+    history = int(values["history"])
+    margin = int(values["margin"])
+    filter_by_last_close = bool(values.getlist("filter-by-last-close"))
+    last_close_margin = int(values["last-close-margin"])
+    return history, margin, filter_by_last_close, last_close_margin
+
+
+def finite(value):
+    """`value` with NaN and infinite floats, nested in dicts and lists too, replaced by None (null in JSON)."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite(item) for item in value]
+    return value
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(finite(data), allow_nan=False)}\n\n"
+
+
 @app.route('/run', methods=['GET', 'POST'])
 def run():
     global stocks
@@ -36,20 +65,68 @@ def run():
     last_close_margin = 5
     filter_by_last_close = True
     if request.method == 'POST':
-        history = int(request.form["history"])
-        margin = int(request.form["margin"])
-        filter_by_last_close = bool(request.form.getlist("filter-by-last-close"))
-        last_close_margin = int(request.form["last-close-margin"])
-        for sname in _stocks:
-            try:
-                result.extend(Algo(sname, history, margin, filter_by_last_close, last_close_margin).run_algo())
-            except Exception as e:
-                print(f"Error occured while running algo {e}")
-                import traceback
-                traceback.print_exc()
+        history, margin, filter_by_last_close, last_close_margin = scan_params(request.form)
+        scan = scan_universe(_stocks, history, margin, filter_by_last_close, last_close_margin)
+        result = scan.results
+        for error in scan.errors:
+            print(f"Error occured while running algo for {error['stock']}: {error['type']}: {error['error']}")
 
     return render_template("runAlgo.html", stocks="\n".join(_stocks), result=result or ["No results!"], history=history, margin=margin, last_close_margin=last_close_margin, filter_by_last_close=filter_by_last_close)
 
 
+@app.route('/run/stream')
+def run_stream():
+    """
+    Server-sent events with the scan progress as each batch of stocks finishes, then the first page of results.
+    Takes the /api/scan arguments; later pages come from /api/scan, answered from the cached result of this scan.
+    """
+    params = scan_params(request.args)
+    _stocks = list(stocks)
+    sort = request.args.get('sort', 'stock-asc')
+    prefix = request.args.get('q', '')
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    try:
+        parse_sort(sort)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        yield sse('progress', {'done': 0, 'total': len(_stocks)})
+        for done, scan in iter_universe(_stocks, *params):
+            yield sse('progress', {'done': done, 'total': len(_stocks)})
+        for error in scan.errors:
+            print(f"Error occured while running algo for {error['stock']}: {error['type']}: {error['error']}")
+        page = paginate(scan.results, sort, prefix, None, limit, token=fingerprint(params, scan.version))
+        page['errors'] = len(scan.errors)
+        yield sse('page', page)
+        yield sse('done', {'total': len(_stocks), 'errors': len(scan.errors), 'elapsed': round(scan.elapsed, 2)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/scan')
+def api_scan():
+    """
+    Scan results as JSON, one page at a time.
+    Takes the runAlgo form fields plus `sort` (e.g. v20margin-desc), `q` (symbol prefix), `cursor` and `limit`.
+    """
+    params = scan_params(request.args)
+    scan = scan_universe(list(stocks), *params)
+    try:
+        page = paginate(scan.results, request.args.get('sort', 'stock-asc'), request.args.get('q', ''),
+                        request.args.get('cursor'), request.args.get('limit', DEFAULT_LIMIT, type=int),
+                        token=fingerprint(params, scan.version))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    page['errors'] = len(scan.errors)
+    return jsonify(finite(page))
+
+
+@app.route('/api/cache-stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Offline backfill of the price store from archived bhavcopies.
+
+Reads a directory of daily bhavcopy files (.csv or .zip, in any layout
+bhavcopy.FORMATS knows) with a process pool, keeps the EQ bars of the
+universe and pivots them into one history per symbol in a single sort.
+
+Bhavcopies carry no corporate actions, but NSE prints the previous close
+adjusted for a split or bonus on its ex-date. Every session whose PREV_CLOSE
+differs from the previous session's close is recorded in the ledger as an
+adjustment with the ratio of the two, and the stored series is adjusted for
+them like a download is for the splits and bonuses of its CA column. Only a
+bar that directly follows the symbol's bar of the previous session counts:
+across a missing file or a spell outside EQ, PREV_CLOSE is the close of a
+bar the archive does not have. An archive with unreadable files or sessions
+missing in the years the NSE holidays are known for is not backfilled.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+import pandas as pd
+from bhavcopy import BAR_COLUMNS, PREV_CLOSE_TOLERANCE, parse_bhavcopy, split_by_symbol
+from config import SCAN_WORKERS, SCAN_BATCH_SIZE
+from data import StockData, add_moving_averages, to_arrays
+from events import update_event_index
+from ledger import ACTION_COLUMNS, ADJUSTMENT, Ledger
+from manifest import manifest
+from trading_calendar import trading_calendar
+
+ARCHIVE_SUFFIXES = ('.csv', '.zip')
+RATIO_DECIMALS = 6
+
+
+def archive_files(directory) -> List[str]:
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(ARCHIVE_SUFFIXES))
+
+
+def _read_batch(paths: List[str], symbols: frozenset):
+    """Bars of `symbols` in the files of `paths`, and the files that could not be read."""
+    frames, failed = [], []
+    for path in paths:
+        try:
+            bars = parse_bhavcopy(pd.read_csv(path, dtype=str))
+        except Exception as e:
+            failed.append((path, str(e)))
+            continue
+        frames.append(bars[bars['Symbol'].isin(symbols).to_numpy()])
+    return (pd.concat(frames, ignore_index=True) if frames else None), failed
+
+
+def read_archive(paths: List[str], symbols, workers: int = SCAN_WORKERS, batch_size: int = SCAN_BATCH_SIZE):
+    """All bars of `symbols` in `paths` as one frame sorted by symbol and date, and the unreadable files."""
+    symbols = frozenset(symbols)
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), max(1, batch_size))]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(batches) <= 1:
+        results = [_read_batch(batch, symbols) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+            results = list(pool.map(_read_batch, batches, [symbols] * len(batches)))
+    frames = [frame for frame, _ in results if frame is not None]
+    failed = [item for _, batch_failed in results for item in batch_failed]
+    if not frames:
+        return pd.DataFrame(columns=['Symbol', 'Date'] + BAR_COLUMNS + ['PrevClose']), failed
+    bars = pd.concat(frames, ignore_index=True).sort_values(['Symbol', 'Date'], kind='stable')
+    # A session in two files (e.g. both layouts of one day) is kept once
+    return bars[~bars.duplicated(['Symbol', 'Date'], keep='last')].reset_index(drop=True), failed
+
+
+def previous_sessions(days: np.ndarray, calendar=trading_calendar) -> np.ndarray:
+    """Session before each of the datetime64[D] `days`, NaT before the first session."""
+    sessions = calendar.sessions()
+    i = np.searchsorted(sessions, days, side='left')
+    previous = sessions[np.maximum(i - 1, 0)].copy()
+    previous[i == 0] = np.datetime64('NaT')
+    return previous
+
+
+def missing_sessions(bars: pd.DataFrame, calendar=trading_calendar) -> np.ndarray:
+    """
+    Sessions between the first and last date of `bars` with no bars at all, in the years the
+    NSE holidays are known for (the fallback holidays are not exact enough to tell).
+    """
+    days = np.unique(bars['Date'].to_numpy(dtype='datetime64[D]'))
+    if not len(days):
+        return days
+    sessions = calendar.sessions_between(days[0], days[-1])
+    sessions = sessions[calendar.is_known(sessions)]
+    return sessions[~np.isin(sessions, days)]
+
+
+def detect_actions(bars: pd.DataFrame, calendar=trading_calendar) -> pd.DataFrame:
+    """
+    Adjustments in `bars` (sorted by symbol and date): sessions whose PREV_CLOSE is not the close
+    of the symbol's bar of the previous session, as ACTION_COLUMNS plus Symbol.
+    """
+    symbols = bars['Symbol'].to_numpy()
+    days = bars['Date'].to_numpy(dtype='datetime64[D]')
+    close = bars['Close'].to_numpy(dtype=np.float64)
+    prev_close = bars['PrevClose'].to_numpy(dtype=np.float64)
+    # The previous bar must be the symbol's, and from the previous session
+    follows = np.r_[False, (symbols[1:] == symbols[:-1]) & (days[:-1] == previous_sessions(days[1:], calendar))]
+    previous = np.r_[np.nan, close[:-1]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = previous / prev_close
+        adjusted = follows & (prev_close > 0) & (np.abs(ratio - 1) > PREV_CLOSE_TOLERANCE)
+    rows = np.flatnonzero(adjusted)
+    return pd.DataFrame({
+        'Symbol': symbols[rows],
+        'ex_date': bars['Date'].to_numpy()[rows],
+        'kind': ADJUSTMENT,
+        'ratio': np.round(ratio[rows], RATIO_DECIMALS),
+        'subject': [f"PREV_CLOSE {prev_close[i]:g} after close {previous[i]:g}" for i in rows],
+    })
+
+
+def write_symbol(symbol: str, raw_df: pd.DataFrame, actions: pd.DataFrame):
+    """Record the raw bars and adjustments of `symbol` in its ledger and store the adjusted series."""
+    ledger = Ledger(symbol)
+    ledger.record(raw_df, actions[ACTION_COLUMNS].reset_index(drop=True))
+    adjusted = add_moving_averages(ledger.adjusted())
+    StockData(symbol).save(adjusted)
+    update_event_index(symbol, to_arrays(adjusted), rebuild=True)
+
+
+def backfill(directory, symbols, overwrite: bool = False, workers: int = SCAN_WORKERS) -> dict:
+    """
+    Store the history of every symbol of `symbols` found in the bhavcopies in `directory`.
+    Symbols that already have stored data are left alone unless `overwrite`. Nothing is written
+    when a file could not be read or sessions are missing from the archive, as an action on the
+    session after one could not be told apart from the gap.
+    """
+    symbols = sorted(set(symbols))
+    if not overwrite:
+        symbols = [symbol for symbol in symbols if StockData(symbol).manifest_entry() is None]
+    counts = {'written': 0, 'not_in_archive': 0, 'unreadable_files': 0, 'missing_sessions': 0}
+    if not symbols:
+        return counts
+    bars, failed = read_archive(archive_files(directory), symbols, workers=workers)
+    counts['unreadable_files'] = len(failed)
+    counts['missing_sessions'] = len(missing_sessions(bars))
+    if failed or counts['missing_sessions']:
+        return counts
+    actions = detect_actions(bars)
+    actions_by_symbol = {symbol: group for symbol, group in actions.groupby('Symbol', sort=False)}
+    no_actions = pd.DataFrame(columns=ACTION_COLUMNS)
+    blocks = split_by_symbol(bars, symbols)
+    with manifest.batch():
+        for symbol in symbols:
+            block = blocks.get(symbol)
+            if block is None:
+                counts['not_in_archive'] += 1
+                continue
+            raw_df = block[BAR_COLUMNS].copy()
+            raw_df.index.name = 'Date'
+            write_symbol(symbol, raw_df, actions_by_symbol.get(symbol, no_actions))
+            counts['written'] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the price store from a directory of archived bhavcopies.")
+    parser.add_argument('directory', help="Directory of bhavcopy .csv or .zip files")
+    parser.add_argument('--overwrite', action='store_true', help="Also replace symbols that already have data")
+    parser.add_argument('--workers', type=int, default=SCAN_WORKERS)
+    args = parser.parse_args()
+    from price_cache import universe
+    from dataset import publish
+    symbols = universe()
+    counts = backfill(args.directory, symbols, overwrite=args.overwrite, workers=args.workers)
+    for status, count in counts.items():
+        print(f"{status}: {count}")
+    if counts['unreadable_files'] or counts['missing_sessions']:
+        print("Nothing written: complete the archive first.")
+        return 1
+    if counts['written']:
+        print(f"Published dataset version {publish(symbols)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
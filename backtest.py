@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Walk-forward backtest of V20 signals over the stored history.
+
+Replays the V20 rule with an as-of cursor: a green run becomes a signal on the
+day before its low is first re-touched, using only bars up to that day for the
+margin, last-close and history-window checks. The re-touch is the entry, the
+run high is the target. Trades come straight from the event index, so the
+whole history is measured in one pass instead of one scan per day.
+
+A run that only partly falls inside the as-of history window is not replayed.
+"""
+import argparse
+import sys
+import time
+from typing import List
+import numpy as np
+import pandas as pd
+from algo import get_stock_arrays, data_version
+from config import STOCKS_FILE
+from engine import fdate
+from events import EventIndex, event_index
+
+COLUMNS = ['stock', 'signal_date', 'low_date', 'high_date', 'v20margin', 'entry_date', 'entry_price', 'target_price',
+           'exit_date', 'exit_price', 'status', 'holding_bars', 'holding_days', 'return_pct', 'max_drawdown_pct']
+
+
+def backtest_symbol(stock: str, data: dict, index: EventIndex, history: int = 200, margin: int = 20,
+                    filter_by_last_close: bool = True, last_close_margin: int = 5, start=None) -> List[list]:
+    """Trades for one stock as rows matching COLUMNS."""
+    dates = np.asarray(data['Date'], dtype='datetime64[D]')
+    n = len(dates)
+    if n == 0 or len(index) == 0:
+        return []
+    _open = np.asarray(data['Open'], dtype=np.float64)
+    high = np.asarray(data['High'], dtype=np.float64)
+    low = np.asarray(data['Low'], dtype=np.float64)
+    close = np.asarray(data['Close'], dtype=np.float64)
+    valid_ma = np.flatnonzero(~np.isnan(np.asarray(data['MA'], dtype=np.float64)))
+    if not len(valid_ma):
+        return []
+
+    entries = index.buys
+    signal = entries - 1  # as-of bar on which the scan shows the run
+    # Runs visible on the signal day: complete, inside its history window and after the first full MA
+    window = np.maximum(valid_ma[0], entries - history)
+    ok = (entries >= 0) & (index.starts >= window + 1)
+    ok &= index.v20margin > margin
+    # for catching weird scenarios that will rise with bad data
+    ok &= ~(dates[index.high_idx] < dates[index.low_idx])
+    if filter_by_last_close:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ok &= 100 * (close[signal] / index.low - 1) <= last_close_margin
+    if start is not None:
+        ok &= dates[np.where(entries >= 0, entries, 0)] >= np.datetime64(start, 'D')
+    picked = np.flatnonzero(ok)
+    if not len(picked):
+        return []
+
+    entry = entries[picked]
+    target = index.high[picked]
+    # Filled at the run low, or at the open when the bar gaps below it
+    entry_price = np.minimum(_open[entry], index.low[picked])
+    exits = np.full(len(picked), -1, dtype=np.int64)
+    for i, (e, t) in enumerate(zip(entry, target)):
+        hits = np.flatnonzero(high[e + 1:] >= t)
+        if len(hits):
+            exits[i] = e + 1 + hits[0]
+    hit = exits >= 0
+    last = np.where(hit, exits, n - 1)
+    # Filled at the target, or at the open when the bar gaps above it; open trades are marked at the last close
+    exit_price = np.where(hit, np.maximum(_open[last], target), close[last])
+    padded_low = np.append(low, np.inf)
+    worst = np.minimum.reduceat(padded_low, np.ravel(np.column_stack([entry, last + 1])))[::2]
+
+    trades = []
+    for i, k in enumerate(picked):
+        trades.append([
+            stock,
+            fdate(dates[signal[k]]),
+            fdate(dates[index.low_idx[k]]),
+            fdate(dates[index.high_idx[k]]),
+            round(index.v20margin[k], 2),
+            fdate(dates[entry[i]]),
+            round(entry_price[i], 2),
+            round(target[i], 2),
+            fdate(dates[exits[i]]) if hit[i] else None,
+            round(exit_price[i], 2),
+            'target' if hit[i] else 'open',
+            int(last[i] - entry[i]),
+            int((dates[last[i]] - dates[entry[i]]).astype(int)),
+            round(100 * (exit_price[i] / entry_price[i] - 1), 2),
+            round(100 * (worst[i] / entry_price[i] - 1), 2),
+        ])
+    return trades
+
+
+def backtest(symbols: List[str], history: int = 200, margin: int = 20, filter_by_last_close: bool = True,
+             last_close_margin: int = 5, start=None, end=None) -> pd.DataFrame:
+    """
+    Replay the V20 rule for every symbol and return one row per trade.
+    Only entries on or after `start` are taken and no bar after `end` is read.
+    """
+    trades = []
+    for symbol in symbols:
+        data = get_stock_arrays(symbol)
+        if data is None:
+            continue
+        if end is not None:
+            cut = np.searchsorted(np.asarray(data['Date'], dtype='datetime64[D]'), np.datetime64(end, 'D'), side='right')
+            data = {col: values[:cut] for col, values in data.items()}
+            index = EventIndex.build(data)
+        else:
+            index = event_index(symbol, data, data_version(symbol))
+        trades.extend(backtest_symbol(symbol, data, index, history, margin, filter_by_last_close,
+                                      last_close_margin, start))
+    return pd.DataFrame(trades, columns=COLUMNS)
+
+
+def summarize(trades: pd.DataFrame) -> dict:
+    closed = trades[trades['status'] == 'target']
+    return {
+        'trades': len(trades),
+        'target_hit': len(closed),
+        'open': len(trades) - len(closed),
+        'hit_rate': round(len(closed) / len(trades), 4) if len(trades) else None,
+        'mean_return_pct': round(trades['return_pct'].mean(), 2) if len(trades) else None,
+        'mean_holding_days_closed': round(closed['holding_days'].mean(), 1) if len(closed) else None,
+        'worst_drawdown_pct': trades['max_drawdown_pct'].min() if len(trades) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Walk-forward backtest of V20 signals.")
+    parser.add_argument('--stocks-file', default=str(STOCKS_FILE), help="File with one symbol per line")
+    parser.add_argument('--history', type=int, default=200)
+    parser.add_argument('--margin', type=int, default=20)
+    parser.add_argument('--no-filter-by-last-close', dest='filter_by_last_close', action='store_false')
+    parser.add_argument('--last-close-margin', type=int, default=5)
+    parser.add_argument('--start', help="Only take entries on or after this date (YYYY-MM-DD)")
+    parser.add_argument('--end', help="Replay up to this date (YYYY-MM-DD), later bars are not read")
+    parser.add_argument('--out', help="Write the trades as CSV to this file")
+    args = parser.parse_args()
+
+    with open(args.stocks_file) as f:
+        symbols = sorted(set(line.strip().upper() for line in f if line.strip()))
+
+    started = time.time()
+    trades = backtest(symbols, args.history, args.margin, args.filter_by_last_close, args.last_close_margin,
+                      args.start, args.end)
+    if args.out:
+        trades.to_csv(args.out, index=False)
+    else:
+        print(trades.to_string(index=False))
+    for key, value in summarize(trades).items():
+        print(f"{key}: {value}", file=sys.stderr)
+    print(f"Backtested {len(symbols)} stocks in {time.time() - started:.2f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
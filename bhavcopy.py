@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Bulk daily update from NSE bhavcopies.
+
+A bhavcopy (sec_bhavdata_full_DDMMYYYY.csv) holds the bars of every security
+for one session. The bulk update fetches it once per session missing from the
+store, or reads it from BHAVCOPY_DIR where fetched files are kept and files
+can be dropped by hand. The EQ rows of the universe are split into one block
+of new bars per symbol and merged like a download.
+
+A symbol is left to the per-symbol equity_history sync when its new bars do
+not follow on from the stored ones: a session missing for it, or a
+PREV_CLOSE that differs from the close before it, which is how NSE shows the
+base price adjusted for a split or bonus on its ex-date.
+"""
+import argparse
+import sys
+from datetime import date, datetime
+from typing import List
+import numpy as np
+import pandas as pd
+from config import BHAVCOPY_DIR, BULK_MAX_SESSIONS
+from data import StockData
+from manifest import manifest
+from trading_calendar import trading_calendar
+
+BAR_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+# The layouts NSE has published bhavcopies in: symbol, series and date columns, date format, value columns
+FORMATS = [
+    ('SYMBOL', 'SERIES', 'DATE1', '%d-%b-%Y', {  # sec_bhavdata_full_DDMMYYYY.csv
+        'OPEN_PRICE': 'Open', 'HIGH_PRICE': 'High', 'LOW_PRICE': 'Low', 'CLOSE_PRICE': 'Close',
+        'TTL_TRD_QNTY': 'Volume', 'PREV_CLOSE': 'PrevClose'}),
+    ('SYMBOL', 'SERIES', 'TIMESTAMP', '%d-%b-%Y', {  # cmDDMONYYYYbhav.csv, before July 2024
+        'OPEN': 'Open', 'HIGH': 'High', 'LOW': 'Low', 'CLOSE': 'Close', 'TOTTRDQTY': 'Volume',
+        'PREVCLOSE': 'PrevClose'}),
+    ('TckrSymb', 'SctySrs', 'TradDt', '%Y-%m-%d', {  # BhavCopy_NSE_CM_0_0_0_YYYYMMDD_F_0000.csv
+        'OpnPric': 'Open', 'HghPric': 'High', 'LwPric': 'Low', 'ClsPric': 'Close', 'TtlTradgVol': 'Volume',
+        'PrvsClsgPric': 'PrevClose'}),
+]
+SERIES = 'EQ'
+PREV_CLOSE_TOLERANCE = 1e-3  # Relative difference of PREV_CLOSE from the previous close taken as an adjustment
+
+
+def bhavcopy_path(day: date, root=BHAVCOPY_DIR):
+    return root / f"sec_bhavdata_full_{day.strftime('%d%m%Y')}.csv"
+
+
+def parse_bhavcopy(raw: pd.DataFrame, day: date = None) -> pd.DataFrame:
+    """
+    EQ bars of a bhavcopy in any of FORMATS as Symbol, Date, BAR_COLUMNS and PrevClose.
+    The dates are read from the file unless the session `day` is given.
+    """
+    raw = raw.rename(columns=lambda col: str(col).strip())
+    for symbol_col, series_col, date_col, date_format, value_cols in FORMATS:
+        if {symbol_col, series_col, *value_cols} <= set(raw.columns):
+            break
+    else:
+        raise ValueError(f"Unknown bhavcopy layout with columns {list(raw.columns)}")
+    raw = raw[(raw[series_col].astype(str).str.strip() == SERIES).to_numpy()]
+    bars = pd.DataFrame({'Symbol': raw[symbol_col].astype(str).str.strip().to_numpy()})
+    if day is not None:
+        bars['Date'] = pd.Timestamp(day)
+    else:
+        bars['Date'] = pd.to_datetime(raw[date_col].astype(str).str.strip(), format=date_format,
+                                      errors='coerce').to_numpy()
+    for source, name in value_cols.items():
+        bars[name] = pd.to_numeric(raw[source].astype(str).str.strip().str.replace(',', '', regex=False),
+                                   errors='coerce').to_numpy()
+    return bars.dropna(subset=['Date'] + BAR_COLUMNS)
+
+
+def load_bhavcopy(day: date, root=BHAVCOPY_DIR, fetch: bool = True):
+    """
+    Parsed bhavcopy of session `day`, from `root` or else from NSE (kept in `root`).
+    None when it is not available, e.g. not published yet.
+    """
+    path = bhavcopy_path(day, root)
+    if not path.exists():
+        if not fetch:
+            return None
+        # Imported here, api pulls in requests and the NSE session setup
+        from api import get_bhavcopy
+        from storage import replace_file
+        try:
+            raw = get_bhavcopy(day.strftime('%d-%m-%Y'))
+            # Only a response that parses as a bhavcopy is kept, not an error page served with a 200
+            bars = parse_bhavcopy(raw, day)
+        except Exception:
+            return None
+        if bars.empty:
+            return None
+        root.mkdir(parents=True, exist_ok=True)
+        replace_file(path, lambda f: raw.to_csv(f, index=False), binary=False)
+        return bars
+    return parse_bhavcopy(pd.read_csv(path, dtype=str), day)
+
+
+def split_by_symbol(bars: pd.DataFrame, symbols) -> dict:
+    """Bars of `symbols` as {symbol: bars sorted by date}, one slice per symbol of one sorted frame."""
+    bars = bars[bars['Symbol'].isin(list(symbols))].sort_values(['Symbol', 'Date'], kind='stable')
+    codes = bars['Symbol'].to_numpy()
+    if not len(codes):
+        return {}
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    bars = bars.set_index('Date')
+    return {codes[start]: bars.iloc[start:end] for start, end in zip(starts, ends)}
+
+
+def plan_sessions(last_dates: dict, target: date, max_sessions: int = BULK_MAX_SESSIONS) -> np.ndarray:
+    """Sessions after the oldest of `last_dates` up to `target`, at most the last `max_sessions` of them."""
+    if not last_dates:
+        return np.empty(0, dtype='datetime64[D]')
+    sessions = trading_calendar.sessions_between(trading_calendar.next_session(min(last_dates.values())), target)
+    return sessions[-max_sessions:]
+
+
+def bulk_update(symbols: List[str], target: datetime, root=BHAVCOPY_DIR, fetch: bool = True, on_result=None):
+    """
+    Bring `symbols` up to `target` from bhavcopies. Returns ({symbol: (status, message)} of the
+    symbols updated, {reason: [symbols]} of those left to the per-symbol sync).
+    `on_result(symbol, status, message)` sees every update.
+    """
+    target = target.date() if isinstance(target, datetime) else target
+    skipped = {'no_data': [], 'behind': [], 'gap': [], 'corporate_action': []}
+    last_dates = {}
+    with manifest.batch():
+        for symbol in symbols:
+            entry = StockData(symbol).manifest_entry()
+            if entry is None:
+                skipped['no_data'].append(symbol)
+            elif date.fromisoformat(entry['last_date']) < target:
+                last_dates[symbol] = date.fromisoformat(entry['last_date'])
+
+    sessions, frames = [], []
+    for session in plan_sessions(last_dates, target):
+        bars = load_bhavcopy(session.astype(object), root, fetch)
+        if bars is None:
+            # Bars after a missing session would leave a gap
+            break
+        sessions.append(session)
+        frames.append(bars)
+    sessions = np.asarray(sessions, dtype='datetime64[D]')
+    if not len(sessions):
+        skipped['behind'].extend(last_dates)
+        return {}, skipped
+
+    blocks = split_by_symbol(pd.concat(frames, ignore_index=True), last_dates)
+    updated = {}
+    with manifest.batch():
+        for symbol, last_date in last_dates.items():
+            needed = sessions[sessions > np.datetime64(last_date, 'D')]
+            if not len(needed) or trading_calendar.next_session(last_date) != needed[0].astype(object):
+                # The bhavcopies do not reach back to the symbol's next session
+                skipped['behind'].append(symbol)
+                continue
+            block = blocks.get(symbol)
+            if block is None or len(block) != len(needed) or \
+                    (block.index.values.astype('datetime64[D]') != needed).any():
+                skipped['gap'].append(symbol)
+                continue
+            stock_data = StockData(symbol)
+            stored = stock_data.load()
+            closes = block['Close'].to_numpy(dtype=np.float64)
+            expected = np.r_[stored['Close'].iloc[-1], closes[:-1]]
+            if (np.abs(block['PrevClose'].to_numpy(dtype=np.float64) - expected) >
+                    PREV_CLOSE_TOLERANCE * expected).any():
+                skipped['corporate_action'].append(symbol)
+                continue
+            status, message = stock_data.apply_bars(block[BAR_COLUMNS], stored)
+            updated[symbol] = (status, message)
+            if on_result is not None:
+                on_result(symbol, status, message)
+    return updated, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the stored prices from NSE bhavcopies.")
+    parser.add_argument('--date', help="Update up to this session (default: the previous session)")
+    parser.add_argument('--local', action='store_true', help="Only use bhavcopies already in the drop directory")
+    args = parser.parse_args()
+    from price_cache import universe
+    target = date.fromisoformat(args.date) if args.date else trading_calendar.previous_session(date.today())
+    updated, skipped = bulk_update(universe(), target, fetch=not args.local)
+    print(f"updated: {len(updated)}")
+    for reason, symbols in skipped.items():
+        print(f"{reason}: {len(symbols)}")
+    if updated:
+        from dataset import publish
+        print(f"Published dataset version {publish()}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
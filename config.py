@@ -4,3 +4,31 @@ DATA_DIR = Path("data")  # Folder where the stock data will be stored
 STOCKS_FILE = Path("stocks")  # Stocks to use
 MASTER_STOCKS_FILE = Path("master-stocks")  # Stocks to use for master data
 DEFAULT_INITIAL_YEARS = 5
+STORAGE = "columnar"  # On-disk format of the per-symbol price files ("columnar" or "csv")
+STORAGE_HEADROOM = 64  # Spare rows kept in each columnar file so new bars are appended in place
+MANIFEST_FILE = DATA_DIR / "manifest.json"  # First/last date, rows, checksum and sync status of every stored file
+DATASET_VERSION_FILE = DATA_DIR / "VERSION"  # Dataset version, increased each time a sync cycle publishes new data
+MA_WINDOWS = (200,)  # Moving-average windows stored alongside the OHLCV data
+PRICE_CACHE_DIR = DATA_DIR / "snapshots"  # Memory-mapped snapshots shared by the web workers
+EVENTS_DIR = DATA_DIR / "events"  # Per-symbol V20 event indexes
+PANEL_DIR = DATA_DIR / "panel"  # Date x symbol matrices of the stored prices
+RAW_DIR = DATA_DIR / "raw"  # Unadjusted downloads and their corporate actions
+HOLIDAYS_FILE = DATA_DIR / "holidays.json"  # NSE trading holidays by year, cached from the holiday master
+HOLIDAYS_MAX_AGE_DAYS = 7  # Re-fetch the NSE holiday master when the cached file is older than this
+NSE_REQUESTS_PER_SECOND = 2.0  # Average rate of requests to NSE across all sync threads
+NSE_BURST = 4  # Requests that may go to NSE back to back before the rate applies
+BULK_UPDATE = True  # Sync from one bhavcopy per missing session before falling back to per-symbol downloads
+BULK_MAX_SESSIONS = 5  # Sessions a symbol may be behind for the bulk update to bring it up to date
+BHAVCOPY_DIR = DATA_DIR / "bhavcopy"  # Fetched bhavcopies, and where bhavcopies can be dropped by hand
+SYNC_WORKERS = 6  # Threads syncing symbols concurrently, their requests share the NSE rate limit
+EOD_PUBLISH_TIME = "18:30"  # Time (IST) from which NSE is expected to have published a session's end-of-day data
+EOD_POLL_MINUTES = 10  # Minutes between cycles after the publish time while the session's data is not out yet
+SYNC_MAX_SLEEP_MINUTES = 60  # Longest the sync sleeps, so symbols added to the stock lists are picked up
+RETRY_BASE_SECONDS = 120  # Wait before retrying a symbol whose sync failed, doubled after every further failure
+RETRY_MAX_SECONDS = 4 * 60 * 60  # Longest wait between retries of a failing symbol
+NSE_SESSIONS = 6  # Pooled HTTP sessions to NSE, each used by one request at a time
+NSE_HISTORY_WORKERS = 4  # Windows of one history download fetched concurrently
+NSE_COOKIE_TTL = 300  # Seconds after which a session fetches new NSE cookies before its next request
+SCAN_WORKERS = None  # Processes used for universe scans (None = one per CPU)
+SCAN_BATCH_SIZE = 25  # Symbols handed to a scan worker at a time
+RESULT_CACHE_BYTES = 64 * 1024 * 1024  # Memory budget of the scan result cache in each web worker
@@ -1,14 +1,25 @@
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 import sys
-import random
 import logging
-import holidays
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
 from api import is_suspended
-from config import DATA_DIR, STOCKS_FILE, DEFAULT_INITIAL_YEARS, MASTER_STOCKS_FILE
+from config import DATA_DIR, STOCKS_FILE, DEFAULT_INITIAL_YEARS, MASTER_STOCKS_FILE, SYNC_WORKERS, \
+    BULK_UPDATE
 from data import StockData
+from dataset import current_version, publish_version
+from manifest import manifest
+from price_cache import build_snapshot, price_cache
+from rate_limit import nse_limiter
+from nse_client import nse_client
+from trading_calendar import trading_calendar
+from scheduler import sync_scheduler, WEB, PRIORITY_NAMES
+import panel
+import bhavcopy
+import integrity
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -24,24 +35,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize Indian holidays calendar
-indian_holidays = holidays.India()
-
 # Global set to track suspended stocks
 suspended_stocks = set()
 
+# Background compaction of the files written during the last cycle
+compaction_thread = None
+
+
+def read_stock_file(file_path):
+    """Read the stock symbols of one stock list file."""
+    if not file_path.exists():
+        raise FileNotFoundError(f"Stock list file '{file_path}' not found. Please create it.")
+    with open(file_path, 'r') as f:
+        stocks = sorted(list(set([line.strip().upper() for line in f if line.strip()])))
+    if not stocks:
+        raise ValueError(f"Stock list file '{file_path}' is empty.")
+    return stocks
+
 
 def get_stock_list():
     """Read stock symbols from stocks.txt and master file."""
-    def _get_stock_list(file_path):
-        if not file_path.exists():
-            raise FileNotFoundError(f"Stock list file '{file_path}' not found. Please create it.")
-        with open(file_path, 'r') as f:
-            stocks = sorted(list(set([line.strip().upper() for line in f if line.strip()])))
-        if not stocks:
-            raise ValueError(f"Stock list file '{file_path}' is empty.")
-        return stocks
-    return list(set(_get_stock_list(STOCKS_FILE) + _get_stock_list(MASTER_STOCKS_FILE)))
+    return list(set(read_stock_file(STOCKS_FILE) + read_stock_file(MASTER_STOCKS_FILE)))
 
 
 def ensure_data_dir():
@@ -51,26 +65,44 @@ def ensure_data_dir():
 
 def get_previous_trading_day(target_date=None):
     """
-    Get the previous trading day, accounting for weekends and Indian holidays.
+    Get the previous NSE trading session before target_date.
     """
     if target_date is None:
         target_date = datetime.now().date()
-    current_date = target_date
-    for _ in range(5):
-        current_date = current_date - timedelta(days=1)
-        if current_date.weekday() >= 5:
-            continue
-        if current_date in indian_holidays:
-            continue
-        return datetime.combine(current_date, datetime.min.time())
-    logger.warning(f"Could not find previous trading day within 5 days of {target_date}")
-    return datetime.combine(target_date, datetime.min.time())
+    try:
+        return datetime.combine(trading_calendar.previous_session(target_date), datetime.min.time())
+    except KeyError:
+        logger.warning(f"Could not find previous trading day before {target_date}")
+        return datetime.combine(target_date, datetime.min.time())
+
+
+def refresh_holidays():
+    """Re-fetch the NSE holiday master when the cached holidays are missing or old."""
+    if not trading_calendar.is_stale():
+        return
+    try:
+        years = trading_calendar.refresh()
+        logger.info(f"Refreshed NSE holidays for {', '.join(sorted(years)) or 'no years'}")
+    except Exception as e:
+        logger.error(f"Failed to refresh NSE holidays: {e}")
+
+
+def session_published(day):
+    """Whether the bhavcopy of session `day` is out, which is when NSE has published the session's data."""
+    try:
+        return bhavcopy.load_bhavcopy(day) is not None
+    except Exception as e:
+        logger.error(f"Failed to load the bhavcopy of {day}: {e}")
+        return False
 
 
 def get_fresh_data_threshold():
-    today = datetime.now().date()
-    previous_trading_day = get_previous_trading_day(today)
-    return previous_trading_day
+    """The latest session whose data NSE has published, today's once it is out after the close."""
+    try:
+        target = sync_scheduler.target(published=session_published)
+    except KeyError:
+        return get_previous_trading_day()
+    return datetime.combine(target, datetime.min.time())
 
 
 def sync_single_stock(symbol, fresh_threshold):
@@ -109,19 +141,181 @@ def sync_single_stock(symbol, fresh_threshold):
         return False, f"error: {e}"
 
 
+def bulk_sync(stocks_to_sync, fresh_threshold, cycle_stats):
+    """
+    Update what the bhavcopies of the missing sessions can and return the stocks still to sync one by one.
+    """
+    def done(symbol, status, message):
+        manifest.record_sync(symbol, status)
+        cycle_stats[status if status in cycle_stats else "updated"] += 1
+
+    try:
+        updated, skipped = bhavcopy.bulk_update(stocks_to_sync, fresh_threshold, on_result=done)
+    except Exception as e:
+        logger.error(f"Bulk update failed: {e}")
+        return stocks_to_sync
+    logger.info(f"Bulk update: {len(updated)} stocks from bhavcopies, left to sync one by one - "
+                + ", ".join(f"{reason}: {len(symbols)}" for reason, symbols in skipped.items()))
+    return [symbol for symbol in stocks_to_sync
+            if symbol not in updated or not StockData(symbol).is_fresh(fresh_threshold)]
+
+
+def sync_stocks(stocks_to_sync, fresh_threshold, cycle_stats):
+    """
+    Sync the symbols on SYNC_WORKERS threads and count the outcomes in cycle_stats.
+    Requests to NSE from all threads share the token bucket in rate_limit, which
+    sets the pace, while the downloads, adjustments and saves of different
+    symbols overlap.
+    """
+    with manifest.batch(), ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="sync") as pool:
+        futures = {pool.submit(sync_single_stock, symbol, fresh_threshold): symbol for symbol in stocks_to_sync}
+        for future in as_completed(futures):
+            symbol = futures[future]
+            success, status = future.result()
+            manifest.record_sync(symbol, status)
+            if success:
+                if status in cycle_stats:
+                    cycle_stats[status] += 1
+                else:
+                    cycle_stats["updated"] += 1
+            else:
+                if status == "suspended":
+                    cycle_stats["suspended"] += 1
+                elif "file_error" in status:
+                    cycle_stats["file_error"] += 1
+                else:
+                    cycle_stats["failed"] += 1
+
+
+def refresh_price_cache(stocks):
+    """Publish a new shared price snapshot for the web workers."""
+    try:
+        version = build_snapshot(stocks)
+        logger.info(f"Published price cache snapshot {version}")
+    except Exception as e:
+        logger.error(f"Failed to build price cache snapshot: {e}")
+
+
+def refresh_panel(stocks):
+    """Extend the date x symbol panel with the bars synced this cycle."""
+    try:
+        logger.info(f"Updated panel: {panel.update(stocks)}")
+    except Exception as e:
+        logger.error(f"Failed to update panel: {e}")
+
+
+def publish_dataset():
+    """Publish a new dataset version once the files, price cache and panel of a cycle are written."""
+    try:
+        logger.info(f"Published dataset version {publish_version()}")
+    except Exception as e:
+        logger.error(f"Failed to publish dataset version: {e}")
+
+
+def publish(stocks):
+    refresh_price_cache(stocks)
+    refresh_panel(stocks)
+    publish_dataset()
+
+
+def sleep_until(wake):
+    logger.info(f"Next cycle at {wake.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+    time.sleep(max(0.0, (wake - sync_scheduler.now()).total_seconds()))
+
+
+def record_retries(symbols, fresh_threshold):
+    """Clear the backoff of the symbols that are now fresh and put the others in the retry queue."""
+    retrying = 0
+    for symbol in symbols:
+        if symbol in suspended_stocks:
+            continue
+        if StockData(symbol).is_fresh(fresh_threshold):
+            sync_scheduler.succeeded(symbol)
+        else:
+            sync_scheduler.failed(symbol)
+            retrying += 1
+    if retrying:
+        logger.info(f"{retrying} stocks still stale, queued for retry with backoff")
+
+
+def changed(cycle_stats):
+    return cycle_stats['updated'] + cycle_stats['initial_download']
+
+
+def repair_data(stocks):
+    """
+    Scan the stored files for anomalies and re-fetch the ranges of the repair plan.
+    Ranges already tried are recorded in the manifest and not fetched again.
+    Returns the number of repaired ranges.
+    """
+    try:
+        report = integrity.scan(stocks)
+    except Exception as e:
+        logger.error(f"Integrity scan failed: {e}")
+        return 0
+    logger.info(f"Integrity scan: {report}")
+
+    def tried(symbol, start, end):
+        entry = manifest.get(symbol) or {}
+        return f"{start}:{end}" in entry.get('repairs', [])
+
+    def done(symbol, start, end, status, message):
+        entry = manifest.get(symbol) or {}
+        manifest.update(symbol, repairs=entry.get('repairs', []) + [f"{start}:{end}"])
+        logger.info(f"{symbol}: {message}")
+
+    try:
+        counts = integrity.repair(report.plan, skip=tried, on_result=done)
+    except Exception as e:
+        logger.error(f"Repair failed: {e}")
+        return 0
+    logger.info(f"Repair Summary - {counts}")
+    return counts.get('repaired', 0)
+
+
+def compact_files(stocks):
+    """Rewrite the stored files that are running out of room for in-place appends."""
+    compacted = 0
+    for symbol in stocks:
+        stock_data = StockData(symbol)
+        try:
+            if stock_data.needs_compaction():
+                stock_data.compact()
+                compacted += 1
+        except Exception as e:
+            logger.error(f"{symbol}: Compaction failed - {e}")
+    if compacted:
+        logger.info(f"Compacted {compacted} stock files")
+
+
+def start_compaction(stocks):
+    global compaction_thread
+    compaction_thread = threading.Thread(target=compact_files, args=(stocks,), name="compaction", daemon=True)
+    compaction_thread.start()
+
+
+def wait_for_compaction():
+    """Compaction rewrites whole files, so it must finish before the next cycle appends to them."""
+    if compaction_thread is not None:
+        compaction_thread.join()
+
+
 def continuous_sync():
     """
-    Continuously sync data until all stocks are fresh
+    Continuously sync data, the stocks the web app scans first, as soon as NSE publishes it
     """
     ensure_data_dir()
     logger.info("Starting continuous sync loop")
     while True:
         try:
             stocks = get_stock_list()  # Reload every cycle
+            web_stocks = set(read_stock_file(STOCKS_FILE))
         except (FileNotFoundError, ValueError) as e:
             logger.error(f"Error: {e}")
             return
+        refresh_holidays()
         fresh_threshold = get_fresh_data_threshold()
+        sync_scheduler.set_target(fresh_threshold.date())
         cycle_stats = {
             "fresh": 0,
             "updated": 0,
@@ -131,42 +325,60 @@ def continuous_sync():
             "file_error": 0,
             "suspended": 0
         }
-        stocks_to_sync = []
-        for symbol in stocks:
-            if symbol in suspended_stocks:
-                cycle_stats["suspended"] += 1
-                continue
-            stock_data = StockData(symbol)
-            if not stock_data.is_fresh(fresh_threshold):
-                stocks_to_sync.append(symbol)
-            else:
-                cycle_stats["fresh"] += 1
-        if not stocks_to_sync:
-            next_check = datetime.now() + timedelta(hours=24)
-            logger.info(f"All stocks fresh. Sleeping 24 hours until {next_check.strftime('%Y-%m-%d %H:%M:%S')}")
-            time.sleep(24 * 60 * 60)
-            continue
-        logger.info(f"Cycle: Syncing {len(stocks_to_sync)} stocks")
-        for i, symbol in enumerate(stocks_to_sync, 1):
-            success, status = sync_single_stock(symbol, fresh_threshold)
-            if success:
-                if status in cycle_stats:
-                    cycle_stats[status] += 1
-                else:
-                    cycle_stats["updated"] += 1
-            else:
-                if status == "suspended":
+        stale_stocks = []
+        with manifest.batch():
+            for symbol in stocks:
+                if symbol in suspended_stocks:
                     cycle_stats["suspended"] += 1
-                elif "file_error" in status:
-                    cycle_stats["file_error"] += 1
+                    continue
+                stock_data = StockData(symbol)
+                if not stock_data.is_fresh(fresh_threshold):
+                    stale_stocks.append(symbol)
                 else:
-                    cycle_stats["failed"] += 1
-
-            # Random delay between stocks to avoid overwhelming the API
-            time.sleep(random.uniform(3, 5))
+                    cycle_stats["fresh"] += 1
+        plan = sync_scheduler.plan(stale_stocks, web_stocks,
+                                   has_data=lambda symbol: StockData(symbol).manifest_entry() is not None)
+        stocks_to_sync = [symbol for symbols in plan.values() for symbol in symbols]
+        if not stocks_to_sync:
+            if not stale_stocks:
+                # A compaction still running could write its old copy of a file over a repair
+                wait_for_compaction()
+                if repair_data(stocks):
+                    publish(stocks)
+                if price_cache.current_version() is None:
+                    refresh_price_cache(stocks)
+                if panel.Panel.open() is None:
+                    refresh_panel(stocks)
+                if current_version() is None:
+                    publish_dataset()
+                logger.info(f"All stocks fresh up to {fresh_threshold.date()}.")
+            else:
+                logger.info(f"{len(stale_stocks)} stale stocks waiting to be retried.")
+            sleep_until(sync_scheduler.next_wake(fresh_threshold.date()))
+            continue
+        logger.info(f"Cycle: Syncing {len(stocks_to_sync)} stocks up to {fresh_threshold.date()} - "
+                    + ", ".join(f"{PRIORITY_NAMES[priority]}: {len(symbols)}" for priority, symbols in plan.items())
+                    + f", waiting to be retried: {len(stale_stocks) - len(stocks_to_sync)}")
+        wait_for_compaction()
+        started = time.time()
+        remaining = bulk_sync(stocks_to_sync, fresh_threshold, cycle_stats) if BULK_UPDATE else stocks_to_sync
+        remaining = set(remaining)
+        published = 0
+        for priority, symbols in plan.items():
+            sync_stocks([symbol for symbol in symbols if symbol in remaining], fresh_threshold, cycle_stats)
+            if priority == WEB and changed(cycle_stats):
+                # The stocks the web app scans are served before the rest of the cycle runs
+                publish(stocks)
+                published = changed(cycle_stats)
+        record_retries(stocks_to_sync, fresh_threshold)
+        logger.info(f"Synced {len(stocks_to_sync)} stocks in {time.time() - started:.0f}s, "
+                    f"NSE requests: {nse_client.stats()}, rate limit: {nse_limiter.stats()}")
         logger.info(f"Cycle Summary - Fresh: {cycle_stats['fresh']}, Updated: {cycle_stats['updated']}, "
                    f"Initial: {cycle_stats['initial_download']}, No Data: {cycle_stats['no_new_data']}, "
                    f"Failed: {cycle_stats['failed']}, File Errors: {cycle_stats['file_error']}, Suspended: {cycle_stats['suspended']}")
+        if changed(cycle_stats) > published:
+            publish(stocks)
+        start_compaction(stocks_to_sync)
 
 def main():
     try:
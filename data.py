@@ -1,126 +1,214 @@
 import pandas as pd
 from datetime import datetime, timedelta, date
-from config import DATA_DIR, DEFAULT_INITIAL_YEARS
+from config import DATA_DIR, DEFAULT_INITIAL_YEARS, MA_WINDOWS, STORAGE
 from api import equity_history
+from events import update_event_index
+from storage import get_storage, STORAGES
+from manifest import manifest
+from trading_calendar import trading_calendar
+from ledger import Ledger, parse_actions, adjust, adjustment_factors, PRICE_COLUMNS
 import os
 import numpy as np
-import re
+import zlib
+
+
+def ma_column(window: int) -> str:
+    return f"MA_{window}"
+
+
+def sum_column(window: int) -> str:
+    return f"SUM_{window}"
+
+
+# Rolling sums are kept at this precision so that carrying a sum forward bar by
+# bar and recomputing it from scratch round the moving average the same way
+SUM_DECIMALS = 6
+
+
+def add_moving_averages(df: pd.DataFrame, windows=MA_WINDOWS) -> pd.DataFrame:
+    """Compute the rolling sum and moving average columns over the whole frame."""
+    for window in windows:
+        sums = df['Close'].rolling(window).sum().round(SUM_DECIMALS)
+        df[sum_column(window)] = sums
+        df[ma_column(window)] = (sums / window).round(2)
+    return df
+
+
+def drop_unconfigured_averages(df: pd.DataFrame, windows=MA_WINDOWS) -> pd.DataFrame:
+    """`df` without the rolling sum and moving average columns of windows no longer in `windows`."""
+    configured = {sum_column(w) for w in windows} | {ma_column(w) for w in windows}
+    stale = [col for col in df.columns if col.startswith(('SUM_', 'MA_')) and col not in configured]
+    return df.drop(columns=stale) if stale else df
+
+
+def extend_moving_averages(df: pd.DataFrame, new_df: pd.DataFrame, windows=MA_WINDOWS) -> pd.DataFrame:
+    """
+    Compute the moving average columns for `new_df`, the bars that follow `df`.
+    Only the new bars are visited: each rolling sum is carried forward from the
+    last stored value by adding the new close and dropping the one leaving the window.
+    """
+    closes = np.concatenate([df['Close'].to_numpy(dtype=float), new_df['Close'].to_numpy(dtype=float)])
+    old_n = len(df)
+    for window in windows:
+        col = sum_column(window)
+        last_sum = df[col].iloc[-1] if col in df.columns and old_n else np.nan
+        sums = np.full(len(new_df), np.nan)
+        for i in range(len(new_df)):
+            pos = old_n + i
+            if pos + 1 < window:
+                continue
+            if np.isnan(last_sum):
+                last_sum = round(closes[pos + 1 - window:pos + 1].sum(), SUM_DECIMALS)
+            else:
+                last_sum = round(last_sum + closes[pos] - closes[pos - window], SUM_DECIMALS)
+            sums[i] = last_sum
+        new_df[col] = sums
+        new_df[ma_column(window)] = np.round(sums / window, 2)
+    return new_df
+
+
+def to_arrays(df: pd.DataFrame) -> dict:
+    """Columns of a price frame as a dict of numpy arrays, with the index under 'Date'."""
+    data = {col: df[col].to_numpy() for col in df.columns}
+    data['Date'] = df.index.values
+    return data
+
+
+CHECKSUM_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+
+def data_checksum(df: pd.DataFrame, crc: int = 0) -> int:
+    """
+    CRC32 of the dates and OHLCV values, row by row in date order, independent of the file format.
+    Pass the checksum of the preceding rows as `crc` to extend it over appended rows.
+    """
+    days = df.index.values.astype('datetime64[D]').astype(np.float64)
+    rows = np.column_stack([days] + [df[col].to_numpy(dtype=np.float64) for col in CHECKSUM_COLUMNS])
+    return zlib.crc32(np.ascontiguousarray(rows).tobytes(), crc)
+
 
 class StockData:
-    def __init__(self, stock: str):
+    def __init__(self, stock: str, storage: str = None):
         self.stock = stock
+        self.storage = get_storage(storage or STORAGE)
         self.file_path = self.get_stock_file_path()
 
-    def get_stock_file_path(self):
+    def get_stock_file_path(self, storage=None):
         file_safe_symbol = self.stock.replace('&', '-')
-        return DATA_DIR / f"{file_safe_symbol}.csv"
+        return DATA_DIR / f"{file_safe_symbol}{(storage or self.storage).suffix}"
+
+    def _stored(self):
+        """(storage, path) of the stored file, falling back to other formats not migrated yet. None if there is none."""
+        for storage in [self.storage] + [s for s in STORAGES.values() if s is not self.storage]:
+            path = self.get_stock_file_path(storage)
+            if path.exists():
+                return storage, path
+        return None
 
     def load(self):
-        """Load stock data from CSV, return DataFrame or None if not exists/empty."""
-        if not self.file_path.exists():
+        """Load the stored stock data, return DataFrame or None if not exists/empty."""
+        stored = self._stored()
+        if stored is None:
             return None
+        storage, path = stored
         try:
-            df = pd.read_csv(self.file_path, index_col='Date', parse_dates=True)
+            df = storage.read(path)
             if df.empty:
                 return None
+            # Files written before a window was configured get it computed on the fly
+            missing = [w for w in MA_WINDOWS if ma_column(w) not in df.columns or sum_column(w) not in df.columns]
+            if missing:
+                df = add_moving_averages(df, missing)
             return df
         except Exception:
             return None
 
+    def version(self):
+        """Token that changes whenever the stored file changes, None if there is no file."""
+        stored = self._stored()
+        if stored is None:
+            return None
+        try:
+            stat = stored[1].stat()
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
     def save(self, df: pd.DataFrame):
-        """Save DataFrame to CSV."""
-        df.to_csv(self.file_path, date_format='%Y-%m-%d', index=True)
+        """Save DataFrame in the configured format, replacing a file left in another format."""
+        self.storage.write(self.file_path, df)
+        for storage in STORAGES.values():
+            if storage is not self.storage:
+                self.get_stock_file_path(storage).unlink(missing_ok=True)
+        self._record(df)
 
-    def is_fresh(self, fresh_threshold: datetime):
-        """Check if the data is fresh (last date >= fresh_threshold)."""
+    def _record(self, df: pd.DataFrame, checksum: int = None):
+        """Record the stored bars in the manifest."""
+        manifest.update(
+            self.stock,
+            first_date=df.index.min().date().isoformat(),
+            last_date=df.index.max().date().isoformat(),
+            rows=len(df),
+            checksum=data_checksum(df) if checksum is None else checksum,
+            version=self.version(),
+        )
+
+    def manifest_entry(self):
+        """Manifest entry for the stored file, refreshed from the file when it is missing or out of date."""
+        entry = manifest.get(self.stock)
+        version = self.version()
+        if entry is not None and entry.get('version') == version and version is not None:
+            return entry
         df = self.load()
-        if df is None or df.empty:
-            return False
-        last_date = df.index.max()
-        return last_date.date() >= fresh_threshold.date()
+        if df is None:
+            if entry is not None and 'version' in entry:
+                manifest.remove(self.stock)
+            return None
+        self._record(df)
+        return manifest.get(self.stock)
 
-    def _apply_corporate_actions(self, df: pd.DataFrame) -> pd.DataFrame:
+    def append(self, new_df: pd.DataFrame) -> bool:
         """
-        Adjusts the DataFrame for splits and bonuses using the 'CA' column.
-        The 'CA' column contains either nan or a list of dicts with 'subject' and 'exDate'.
+        Write only `new_df`, bars following the stored ones, to the end of the stored file.
+        False when it can not be done in place and the whole frame has to be saved instead.
         """
-        if 'CA' not in df.columns:
-            return df
-        # Collect all actions
-        actions = []
-        for idx, ca_cell in df['CA'].items():
-            # Robustly skip empty/invalid ca_cell
-            skip = False
-            if ca_cell is None:
-                skip = True
-            elif isinstance(ca_cell, float) and np.isnan(ca_cell):
-                skip = True
-            elif isinstance(ca_cell, (list, dict)) and not ca_cell:
-                skip = True
-            elif isinstance(ca_cell, str) and ca_cell.strip() == '':
-                skip = True
-            if skip:
-                continue
-            # If already a list/dict, use as is, else try to eval
-            ca_list = ca_cell
-            if isinstance(ca_list, str):
-                try:
-                    ca_list = eval(ca_list)
-                except Exception:
-                    continue
-            if not isinstance(ca_list, list):
-                ca_list = [ca_list]
-            for ca in ca_list:
-                if not isinstance(ca, dict):
-                    continue
-                subject = ca.get('subject', '')
-                ex_date = ca.get('exDate', None)
-                if not ex_date or not subject:
-                    continue
-                try:
-                    ex_date_dt = pd.to_datetime(ex_date, errors='coerce')
-                except Exception:
-                    continue
-                if pd.isna(ex_date_dt):
-                    continue
-                # Split
-                if 'Face Value Split' in subject:
-                    m = re.search(r'From Rs ([\d\.]+)[^\d]+To (Re|Rs) ([\d\.]+)', subject)
-                    if m:
-                        from_val = float(m.group(1))
-                        to_val = float(m.group(3))
-                        if from_val > 0 and to_val > 0 and from_val != to_val:
-                            actions.append({
-                                'type': 'split',
-                                'ex_date': ex_date_dt,
-                                'ratio': from_val / to_val
-                            })
-                # Bonus
-                elif 'Bonus' in subject:
-                    m = re.search(r'Bonus (\d+):(\d+)', subject)
-                    if m:
-                        bonus_num = int(m.group(1))
-                        bonus_den = int(m.group(2))
-                        if bonus_den > 0:
-                            actions.append({
-                                'type': 'bonus',
-                                'ex_date': ex_date_dt,
-                                'ratio': (bonus_num + bonus_den) / bonus_den
-                            })
-        # Sort actions by ex_date ascending
-        actions.sort(key=lambda x: x['ex_date'])
-        # Apply each action in order
-        for action in actions:
-            mask = df.index < action['ex_date']
-            ratio = action['ratio']
-            df.loc[mask, ['Open', 'High', 'Low', 'Close']] = df.loc[mask, ['Open', 'High', 'Low', 'Close']] / ratio
-            df.loc[mask, 'Volume'] = df.loc[mask, 'Volume'] * ratio
-        # Remove CA column
-        df = df.drop(columns=['CA'])
-        return df
+        stored = self._stored()
+        if stored is None or stored[0] is not self.storage:
+            return False
+        entry = manifest.get(self.stock)
+        in_manifest = entry is not None and entry.get('version') == self.version()
+        if not self.storage.append(stored[1], new_df):
+            return False
+        if in_manifest:
+            manifest.update(self.stock, last_date=new_df.index.max().date().isoformat(),
+                            rows=entry['rows'] + len(new_df), checksum=data_checksum(new_df, entry['checksum']),
+                            version=self.version())
+        else:
+            self.manifest_entry()
+        return True
+
+    def needs_compaction(self) -> bool:
+        stored = self._stored()
+        return stored is not None and stored[0].needs_compaction(stored[1])
+
+    def compact(self):
+        """Rewrite the stored file, restoring the spare rows used by in-place appends."""
+        df = self.load()
+        if df is not None:
+            self.save(df)
+
+    def is_fresh(self, fresh_threshold: datetime):
+        """Check if the data is fresh (last date >= fresh_threshold), from the manifest."""
+        entry = self.manifest_entry()
+        if entry is None:
+            return False
+        return date.fromisoformat(entry['last_date']) >= fresh_threshold.date()
 
     def download(self, start_date: date, end_date: date):
-        """Download stock data using equity_history, return DataFrame and errors."""
+        """
+        Download stock data using equity_history, return the raw (unadjusted) DataFrame and errors.
+        The 'CA' column with the corporate actions is kept when NSE returns one.
+        """
         start_date_str = start_date.strftime('%d-%m-%Y')
         end_date_str = end_date.strftime('%d-%m-%Y')
         errors = []
@@ -151,8 +239,6 @@ class StockData:
             df.dropna(subset=['Open', 'High', 'Low', 'Close', 'Volume'], inplace=True)
             df.sort_values(by='Date', inplace=True)
             df = df.set_index('Date')
-            # Apply corporate actions
-            df = self._apply_corporate_actions(df)
             return df, errors
         except Exception as e:
             errors.append(f"Error downloading data for {self.stock}: {e}")
@@ -160,6 +246,52 @@ class StockData:
             print(traceback.format_exc())
             return None, errors
 
+    def _record_download(self, raw_df: pd.DataFrame):
+        """
+        Store a download in the raw ledger and return (adjusted bars, actions not seen before).
+        The bars are adjusted for every action recorded for the stock, including those in the download.
+        """
+        actions = parse_actions(raw_df['CA'] if 'CA' in raw_df.columns else pd.Series(dtype=object))
+        raw_df = raw_df.drop(columns=['CA'], errors='ignore')
+        ledger = Ledger(self.stock)
+        new_actions = ledger.record(raw_df, actions)
+        return adjust(raw_df, ledger.load_actions()), new_actions
+
+    @staticmethod
+    def _adjust_history(df: pd.DataFrame, new_actions: pd.DataFrame) -> pd.DataFrame:
+        """Stored bars adjusted for actions seen for the first time, `df` itself when none applies."""
+        factors = adjustment_factors(df.index.values, new_actions)
+        if not (factors != 1).any():
+            return df
+        df = df.copy()
+        df[PRICE_COLUMNS] = df[PRICE_COLUMNS].to_numpy(dtype=np.float64) / factors[:, None]
+        df['Volume'] = df['Volume'].to_numpy() * factors
+        return df
+
+    def refetch(self, start_date: date, end_date: date):
+        """
+        Re-download the bars from start_date to end_date and replace the stored bars of that range with them.
+        Used to run the repair plans of the integrity scanner. Returns (status, message).
+        """
+        df = self.load()
+        if df is None:
+            return 'failed', f"No stored data to repair for {self.stock}"
+        new_df, errors = self.download(start_date, end_date)
+        if new_df is None:
+            return 'failed', f"Repair download failed for {self.stock}: {errors}"
+        elif new_df.empty:
+            return 'no_new_data', f"No data for {self.stock} from {start_date} to {end_date}"
+        new_df, new_actions = self._record_download(new_df)
+        df = self._adjust_history(df, new_actions)
+        inside = (df.index >= pd.Timestamp(start_date)) & (df.index <= pd.Timestamp(end_date))
+        combined_df = pd.concat([df.loc[~inside, new_df.columns], new_df])
+        combined_df = combined_df[~combined_df.index.duplicated(keep='last')]
+        combined_df.sort_index(inplace=True)
+        combined_df = add_moving_averages(combined_df)
+        self.save(combined_df)
+        update_event_index(self.stock, to_arrays(combined_df), rebuild=True)
+        return 'repaired', f"Repaired {self.stock} from {start_date} to {end_date}"
+
     def update_to_date(self, target_date: datetime, initial_years=DEFAULT_INITIAL_YEARS):
         """
         Ensure data is up to date to target_date. Handles initial download and incremental update.
@@ -171,7 +303,10 @@ class StockData:
             start_date = target_date.date() - timedelta(days=initial_years * 365)
             new_df, errors = self.download(start_date, target_date.date())
             if new_df is not None and not new_df.empty:
+                new_df, _ = self._record_download(new_df)
+                new_df = add_moving_averages(new_df)
                 self.save(new_df)
+                update_event_index(self.stock, to_arrays(new_df), rebuild=True)
                 return 'initial_download', f"Initial download successful for {self.stock}"
             else:
                 return 'failed', f"Initial download failed for {self.stock}: {errors}"
@@ -180,7 +315,8 @@ class StockData:
             if last_date.date() >= target_date.date():
                 return 'already_up_to_date', f"{self.stock} already up to date."
             start_update_date = last_date.date() + timedelta(days=1)
-            if start_update_date > target_date.date():
+            if trading_calendar.next_session(last_date) > target_date.date():
+                # No session between the last stored bar and target_date
                 return 'already_up_to_date', f"{self.stock} already up to date."
             new_df, errors = self.download(start_update_date, target_date.date())
             if new_df is None:
@@ -188,8 +324,45 @@ class StockData:
             elif new_df.empty:
                 return 'no_new_data', f"No new data for {self.stock}"
             else:
-                combined_df = pd.concat([df, new_df])
-                combined_df = combined_df[~combined_df.index.duplicated(keep='last')]
-                combined_df.sort_index(inplace=True)
-                self.save(combined_df)
+                self._merge_update(df, new_df)
                 return 'updated', f"Update successful for {self.stock}"
+
+    def apply_bars(self, raw_df: pd.DataFrame, df: pd.DataFrame = None):
+        """
+        Merge raw bars obtained other than by download (a bhavcopy) into the stored data,
+        exactly as downloaded bars are. `df` is the stored data when the caller already loaded it.
+        Returns (status, message) like update_to_date.
+        """
+        df = self.load() if df is None else df
+        if df is None:
+            return 'failed', f"No stored data for {self.stock} to add bars to"
+        if raw_df.empty:
+            return 'no_new_data', f"No new data for {self.stock}"
+        self._merge_update(df, raw_df)
+        return 'updated', f"Update successful for {self.stock}"
+
+    def _merge_update(self, df: pd.DataFrame, new_df: pd.DataFrame):
+        """Record the raw bars of an update in the ledger and merge them into the stored bars `df`."""
+        last_date = df.index.max()
+        new_df, new_actions = self._record_download(new_df)
+        # A split or bonus in the new bars also adjusts the stored history
+        adjusted = self._adjust_history(df, new_actions)
+        appended = new_df.index.min() > last_date and adjusted is df
+        df = adjusted
+        if appended:
+            # Only new bars: extend the stored rolling sums over them and write just those rows
+            new_df = extend_moving_averages(df, new_df)
+            # A file with other columns (windows no longer configured) is rewritten instead
+            appended = set(new_df.columns) == set(df.columns)
+        if appended:
+            new_df = new_df[df.columns]
+            combined_df = pd.concat([df, new_df])
+            if not self.append(new_df):
+                self.save(combined_df)
+        else:
+            combined_df = pd.concat([df, new_df])
+            combined_df = combined_df[~combined_df.index.duplicated(keep='last')]
+            combined_df.sort_index(inplace=True)
+            combined_df = add_moving_averages(drop_unconfigured_averages(combined_df))
+            self.save(combined_df)
+        update_event_index(self.stock, to_arrays(combined_df), rebuild=not appended)
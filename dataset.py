@@ -0,0 +1,68 @@
+"""
+Dataset version of the price store.
+
+DATASET_VERSION_FILE holds one integer that only ever increases. The sync
+loop publishes the next one after a cycle has written its files and rebuilt
+the price cache and panel, so a version names a complete, consistent state of
+the data. Caches key on it instead of expiring entries on a timer: an entry
+made under an older version is simply never looked up again.
+
+The file is replaced through a temp file and os.replace, so readers need no
+lock and always see a whole number. Writers hold an flock on a lock file next
+to it, so the sync loop and a CLI never publish the same number.
+
+Every command that rewrites stored prices ends with `publish`, which rebuilds
+the price cache and panel before publishing the next version.
+"""
+import fcntl
+import os
+import tempfile
+import threading
+from config import DATASET_VERSION_FILE
+
+_lock = threading.Lock()
+LOCK_SUFFIX = '.lock'
+
+
+def current_version(path=DATASET_VERSION_FILE):
+    """The published dataset version, None if none has been published."""
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def publish_version(path=DATASET_VERSION_FILE) -> int:
+    """Publish the next dataset version and return it."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _lock, open(path.with_name(path.name + LOCK_SUFFIX), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            version = (current_version(path) or 0) + 1
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.version-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(str(version))
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return version
+
+
+def publish(symbols=None) -> int:
+    """
+    Rebuild the price cache snapshot and the panel of `symbols` (default: the whole universe)
+    from the price store and publish the next dataset version, so the web workers and the scan
+    result cache pick up the new data. Returns the version.
+    """
+    # Imported here, both build on data, which the CLIs calling this have imported already
+    from price_cache import build_snapshot, universe
+    import panel
+    symbols = universe() if symbols is None else symbols
+    build_snapshot(symbols)
+    panel.update(symbols)
+    return publish_version()
@@ -0,0 +1,120 @@
+"""
+Vectorized V20 scan engine.
+
+Works directly on OHLC arrays instead of walking a list of ``Price`` objects.
+The output of :func:`scan` is identical to ``Algo.run_algo`` on the same bars.
+"""
+import numpy as np
+
+
+def green_runs(_open: np.ndarray, close: np.ndarray):
+    """
+    Return (starts, ends) of the green-candle runs walked by the V20 scan.
+
+    A run is a maximal block of green bars in ``[start, end)``. The first bar
+    is never a run start, matching ``Algo.run_algo`` which begins at index 1.
+    """
+    green = np.asarray(close) > np.asarray(_open)
+    if len(green):
+        green[0] = False
+    edges = np.diff(np.concatenate(([False], green, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return starts, ends
+
+
+def run_extremes(low: np.ndarray, high: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    """
+    Return (low_idx, high_idx) for every run.
+
+    Ties resolve to the earliest bar, like the strict comparisons in ``Algo._run``.
+    """
+    if len(starts) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    lengths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # Bar index of every position in the concatenated runs
+    bars = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+
+    def first_extreme(values, reduce):
+        seg = values[bars]
+        best = reduce.reduceat(seg, offsets)
+        hits = np.flatnonzero(seg == np.repeat(best, lengths))
+        return bars[hits[np.searchsorted(hits, offsets)]]
+
+    return first_extreme(low, np.minimum), first_extreme(high, np.maximum)
+
+
+def buy_indices(low: np.ndarray, ends: np.ndarray, low_values: np.ndarray) -> np.ndarray:
+    """First bar at or after each run end whose low re-touches the run low (-1 if none)."""
+    result = np.full(len(ends), -1, dtype=np.int64)
+    for i, (end, value) in enumerate(zip(ends, low_values)):
+        hits = np.flatnonzero(low[end:] <= value)
+        if len(hits):
+            result[i] = end + hits[0]
+    return result
+
+
+def fdate(value) -> str:
+    """Format a numpy/pandas date the same way as ``Price.fdate``."""
+    return np.datetime64(value, 'D').astype(object).strftime("%-d-%b-%Y")
+
+
+def v20_margins(low_values: np.ndarray, high_values: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 100 * (high_values / low_values - 1)
+
+
+def select(dates, low_idx, high_idx, low_values, v20margin, last_close, margin: int,
+           filter_by_last_close: bool, last_close_margin: int) -> np.ndarray:
+    """Boolean mask of the runs that pass the V20 margin, last-close and sanity checks."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = v20margin > margin
+        if filter_by_last_close:
+            valid &= 100 * (last_close / low_values - 1) <= last_close_margin
+    # for catching weird scenarios that will rise with bad data
+    valid &= ~(dates[high_idx] < dates[low_idx])
+    return valid
+
+
+def rows(stock: str, dates, ma, starts, low_idx, high_idx, low_values, high_values, v20margin, buys, last_close):
+    """Build the result dicts for already selected runs."""
+    ans = []
+    for i, buy in enumerate(buys):
+        profit_potential = 100 * (high_values[i] / last_close - 1)
+        ans.append({
+            'stock': stock,
+            'profit_margin': round(profit_potential, 2),
+            'v20margin': round(v20margin[i], 2),
+            'ma': round(ma[starts[i] - 1], 2),
+            'low_date': fdate(dates[low_idx[i]]),
+            'low_price': round(low_values[i], 2),
+            'high_date': fdate(dates[high_idx[i]]),
+            'high_price': round(high_values[i], 2),
+            'buy_date': fdate(dates[buy]) if buy >= 0 else None
+        })
+    return ans
+
+
+def scan(stock: str, dates, _open, close, low, high, ma, margin: int = 20,
+         filter_by_last_close: bool = True, last_close_margin: int = 5):
+    """Run the V20 scan over OHLC arrays and return the same dicts as ``Algo.run_algo``."""
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    low = np.asarray(low, dtype=np.float64)
+    high = np.asarray(high, dtype=np.float64)
+    ma = np.asarray(ma, dtype=np.float64)
+    if len(dates) == 0:
+        return []
+
+    starts, ends = green_runs(_open, close)
+    low_idx, high_idx = run_extremes(low, high, starts, ends)
+    low_values = low[low_idx]
+    high_values = high[high_idx]
+    v20margin = v20_margins(low_values, high_values)
+    last_close = np.float64(close[-1])
+    picked = np.flatnonzero(select(dates, low_idx, high_idx, low_values, v20margin, last_close,
+                                   margin, filter_by_last_close, last_close_margin))
+    buys = buy_indices(low, ends[picked], low_values[picked])
+    return rows(stock, dates, ma, starts[picked], low_idx[picked], high_idx[picked], low_values[picked],
+                high_values[picked], v20margin[picked], buys, last_close)
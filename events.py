@@ -0,0 +1,213 @@
+"""
+Threshold-independent V20 event index.
+
+Every green run has a fixed low, high, start, end and buy-date re-touch that do
+not depend on `margin` or `last_close_margin`. The index stores them once per
+symbol, so a scan is a vectorized filter over events instead of a rescan of
+the prices. When new bars arrive the index is extended over the new bars only.
+"""
+import numpy as np
+import engine
+from config import EVENTS_DIR
+from storage import replace_file
+
+INT_FIELDS = ('starts', 'ends', 'low_idx', 'high_idx', 'buys')
+FLOAT_FIELDS = ('low', 'high', 'v20margin')
+
+
+class EventIndex:
+    def __init__(self, n_bars: int, last_date, starts, ends, low_idx, high_idx, low, high, v20margin, buys):
+        self.n_bars = n_bars
+        self.last_date = last_date  # np.datetime64 of the last indexed bar, None when empty
+        self.starts = starts
+        self.ends = ends
+        self.low_idx = low_idx
+        self.high_idx = high_idx
+        self.low = low
+        self.high = high
+        self.v20margin = v20margin
+        self.buys = buys  # First re-touch of the run low after the run, -1 while there is none
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __str__(self):
+        return f"< EventIndex | Bars {self.n_bars} | Events {len(self)} | Last {self.last_date} >"
+
+    @classmethod
+    def build(cls, data: dict, offset: int = 0):
+        """Index the green runs of the bars in `data` starting at `offset`. Bar `offset` is never a run start."""
+        dates = np.asarray(data['Date'], dtype='datetime64[D]')
+        low = np.asarray(data['Low'], dtype=np.float64)
+        high = np.asarray(data['High'], dtype=np.float64)
+        starts, ends = engine.green_runs(data['Open'][offset:], data['Close'][offset:])
+        starts += offset
+        ends += offset
+        low_idx, high_idx = engine.run_extremes(low, high, starts, ends)
+        low_values, high_values = low[low_idx], high[high_idx]
+        return cls(
+            len(dates), dates[-1] if len(dates) else None,
+            starts, ends, low_idx, high_idx, low_values, high_values,
+            engine.v20_margins(low_values, high_values),
+            engine.buy_indices(low, ends, low_values),
+        )
+
+    def matches(self, data: dict) -> bool:
+        dates = data['Date']
+        if self.n_bars != len(dates):
+            return False
+        return self.n_bars == 0 or np.datetime64(dates[-1], 'D') == self.last_date
+
+    def is_prefix_of(self, data: dict) -> bool:
+        dates = data['Date']
+        if self.n_bars == 0 or self.n_bars > len(dates):
+            return False
+        return np.datetime64(dates[self.n_bars - 1], 'D') == self.last_date
+
+    def extend(self, data: dict):
+        """
+        Return the index for `data`, whose first n_bars bars are the ones already indexed.
+        Only the new bars are scanned: a run still open at the old last bar is
+        re-detected, and runs still waiting for a buy-date re-touch are checked
+        against the new bars.
+        """
+        old_n = self.n_bars
+        low = np.asarray(data['Low'], dtype=np.float64)
+        keep = len(self)
+        if keep and self.ends[-1] == old_n:
+            # Last run was still open, it may continue into the new bars
+            keep -= 1
+        rescan_from = self.starts[keep] if keep < len(self) else old_n
+        fresh = EventIndex.build(data, offset=max(rescan_from - 1, 0))
+
+        buys = self.buys[:keep].copy()
+        pending = np.flatnonzero(buys < 0)
+        retouch = engine.buy_indices(low, np.full(len(pending), old_n, dtype=np.int64), self.low[:keep][pending])
+        buys[pending] = retouch
+
+        def merged(name, old):
+            return np.concatenate([old[:keep], getattr(fresh, name)])
+        return EventIndex(
+            fresh.n_bars, fresh.last_date,
+            merged('starts', self.starts), merged('ends', self.ends),
+            merged('low_idx', self.low_idx), merged('high_idx', self.high_idx),
+            merged('low', self.low), merged('high', self.high), merged('v20margin', self.v20margin),
+            np.concatenate([buys, fresh.buys]),
+        )
+
+    def window(self, data: dict, start: int) -> dict:
+        """
+        Events of the window data[start:] as a dict of arrays, as the scan would find them there.
+
+        Events starting after the window's first bar are exact. A run that begins
+        at or before it is cut at the window edge, so that one run is re-measured.
+        """
+        first = np.searchsorted(self.starts, start + 1)
+        events = {name: getattr(self, name)[first:] for name in INT_FIELDS + FLOAT_FIELDS}
+        if first > 0 and self.ends[first - 1] > start + 1:
+            # Run straddling the window edge, as seen from inside the window
+            low = np.asarray(data['Low'], dtype=np.float64)
+            high = np.asarray(data['High'], dtype=np.float64)
+            s, e = start + 1, self.ends[first - 1]
+            lo = s + int(np.argmin(low[s:e]))
+            hi = s + int(np.argmax(high[s:e]))
+            edge = {
+                'starts': [s], 'ends': [e], 'low_idx': [lo], 'high_idx': [hi],
+                'low': low[lo:lo + 1], 'high': high[hi:hi + 1],
+                'v20margin': engine.v20_margins(low[lo:lo + 1], high[hi:hi + 1]),
+                'buys': engine.buy_indices(low, np.array([e]), low[lo:lo + 1]),
+            }
+            events = {name: np.concatenate((edge[name], values)) for name, values in events.items()}
+        return events
+
+    def scan(self, stock: str, data: dict, start: int, margin: int = 20, filter_by_last_close: bool = True,
+             last_close_margin: int = 5):
+        """Filter the events into the same dicts Algo.run_algo returns for the window data[start:]."""
+        dates = np.asarray(data['Date'], dtype='datetime64[D]')
+        if start >= len(dates):
+            return []
+        ev = self.window(data, start)
+        last_close = np.float64(data['Close'][-1])
+        picked = np.flatnonzero(engine.select(dates, ev['low_idx'], ev['high_idx'], ev['low'], ev['v20margin'],
+                                              last_close, margin, filter_by_last_close, last_close_margin))
+        ev = {name: values[picked] for name, values in ev.items()}
+        return engine.rows(stock, dates, np.asarray(data['MA'], dtype=np.float64), ev['starts'], ev['low_idx'],
+                           ev['high_idx'], ev['low'], ev['high'], ev['v20margin'], ev['buys'], last_close)
+
+    def save(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in INT_FIELDS + FLOAT_FIELDS}
+        last_date = self.last_date if self.last_date is not None else np.datetime64('NaT', 'D')
+        replace_file(path, lambda f: np.savez(f, n_bars=np.int64(self.n_bars),
+                                              last_date=np.asarray(last_date, dtype='datetime64[D]'), **arrays))
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved index, None if it is missing or unreadable."""
+        try:
+            with np.load(path) as f:
+                last_date = f['last_date'][()]
+                return cls(
+                    int(f['n_bars']), None if np.isnat(last_date) else last_date,
+                    *(f[name] for name in INT_FIELDS[:4]), *(f[name] for name in FLOAT_FIELDS), f['buys'],
+                )
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def index_path(stock: str):
+    return EVENTS_DIR / f"{stock.replace('&', '-')}.npz"
+
+
+def update_event_index(stock: str, data: dict, rebuild: bool = False) -> EventIndex:
+    """
+    Bring the stored index for `stock` up to date with `data` and save it.
+    Pass `rebuild=True` when already indexed bars may have changed.
+    """
+    index = None if rebuild else EventIndex.load(index_path(stock))
+    if index is not None and index.matches(data):
+        return index
+    if index is not None and index.is_prefix_of(data):
+        index = index.extend(data)
+    else:
+        index = EventIndex.build(data)
+    index.save(index_path(stock))
+    return index
+
+
+_memo = {}
+
+
+def event_index(stock: str, data: dict, version=None) -> EventIndex:
+    """
+    Event index matching `data`, memoized per process by data version.
+    Uses the stored index when it matches and extends or rebuilds it in memory otherwise.
+    """
+    memo = _memo.get(stock)
+    if memo is not None and version is not None and memo[0] == version:
+        return memo[1]
+    index = EventIndex.load(index_path(stock))
+    if index is None or not (index.matches(data) or index.is_prefix_of(data)):
+        index = EventIndex.build(data)
+    elif not index.matches(data):
+        index = index.extend(data)
+    if version is not None:
+        _memo[stock] = (version, index)
+    return index
+
+
+def main():
+    # Imported here, data imports this module to keep the indexes updated on sync
+    from data import StockData, to_arrays
+    from price_cache import universe
+    built = 0
+    for stock in universe():
+        df = StockData(stock).load()
+        if df is not None:
+            update_event_index(stock, to_arrays(df))
+            built += 1
+    print(f"Updated event indexes for {built} stocks in {EVENTS_DIR}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Integrity scanner and repair planner for the stored price files.
+
+Checks every symbol in parallel for duplicate or out-of-order dates, missing
+or non-positive prices, bars whose high/low do not contain the open/close,
+split-sized price jumps that were never adjusted, and trading sessions missing
+between a symbol's first and last bar. Sessions come from the NSE trading
+calendar for the years whose holidays it has from NSE, and are inferred from
+the dates most symbols have bars on for older years.
+
+Each anomaly is tied to a date, and the dates of a symbol are merged into a
+few date ranges to re-fetch: the repair plan. `repair` runs a plan through
+StockData.refetch, which replaces just those ranges.
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import List
+import numpy as np
+import pandas as pd
+from config import STOCKS_FILE, SCAN_WORKERS, SCAN_BATCH_SIZE
+from data import StockData
+from manifest import manifest
+from trading_calendar import trading_calendar
+
+ANOMALY_COLUMNS = ['stock', 'date', 'kind', 'detail']
+KINDS = ('duplicate_date', 'unsorted', 'missing_price', 'non_positive_price', 'ohlc_inconsistent', 'split_jump',
+         'missing_session')
+SPLIT_JUMP = 1.45  # Overnight ratio between bars that only a split, bonus or consolidation explains
+CALENDAR_QUORUM = 0.5  # Share of symbols that must have a bar on a date for it to count as a session
+MERGE_GAP_DAYS = 10  # Anomalies closer than this are re-fetched in one range
+OHLC_TOLERANCE = 1e-6
+
+
+def _flag(anomalies: list, symbol: str, dates: np.ndarray, positions, kind: str, detail=lambda i: ''):
+    for i in positions:
+        anomalies.append((symbol, str(dates[i]), kind, detail(i)))
+
+
+def check_symbol(symbol: str):
+    """Anomalies of one stored file that need no calendar, and its bar dates (None if nothing is stored)."""
+    df = StockData(symbol).load()
+    if df is None:
+        return [], None
+    dates = df.index.values.astype('datetime64[D]')
+    prices = {col: df[col].to_numpy(dtype=np.float64) for col in ['Open', 'High', 'Low', 'Close']}
+    _open, high, low, close = prices['Open'], prices['High'], prices['Low'], prices['Close']
+    anomalies = []
+
+    days = dates.astype(np.int64)
+    _flag(anomalies, symbol, dates, np.flatnonzero(days[1:] == days[:-1]) + 1, 'duplicate_date')
+    _flag(anomalies, symbol, dates, np.flatnonzero(days[1:] < days[:-1]) + 1, 'unsorted',
+          lambda i: f"after {dates[i - 1]}")
+
+    stacked = np.column_stack(list(prices.values()))
+    missing = np.isnan(stacked).any(axis=1)
+    _flag(anomalies, symbol, dates, np.flatnonzero(missing), 'missing_price')
+    with np.errstate(invalid='ignore'):
+        non_positive = (stacked <= 0).any(axis=1)
+        _flag(anomalies, symbol, dates, np.flatnonzero(non_positive), 'non_positive_price')
+        top = np.maximum.reduce([_open, close, low])
+        bottom = np.minimum.reduce([_open, close, high])
+        inconsistent = (high < top * (1 - OHLC_TOLERANCE)) | (low > bottom * (1 + OHLC_TOLERANCE))
+        _flag(anomalies, symbol, dates, np.flatnonzero(inconsistent & ~missing & ~non_positive), 'ohlc_inconsistent')
+
+        # A jump the whole next bar trades beyond, in either direction
+        gap = close[:-1] / _open[1:]
+        stay = close[:-1] / close[1:]
+        jump = ((gap >= SPLIT_JUMP) & (stay >= SPLIT_JUMP)) | ((gap <= 1 / SPLIT_JUMP) & (stay <= 1 / SPLIT_JUMP))
+        jump &= (gap > 0) & (stay > 0)
+    _flag(anomalies, symbol, dates, np.flatnonzero(jump) + 1, 'split_jump',
+          lambda i: f"x{close[i - 1] / _open[i]:.2f}")
+    return anomalies, days
+
+
+def _check_batch(symbols: List[str]):
+    return [(symbol, *check_symbol(symbol)) for symbol in symbols]
+
+
+def infer_calendar(days_by_symbol: dict) -> np.ndarray:
+    """Sessions (int64 epoch days) on which at least CALENDAR_QUORUM of the symbols have a bar."""
+    if not days_by_symbol:
+        return np.empty(0, dtype=np.int64)
+    values, counts = np.unique(np.concatenate([np.unique(days) for days in days_by_symbol.values()]),
+                               return_counts=True)
+    return values[counts >= CALENDAR_QUORUM * len(days_by_symbol)]
+
+
+def session_calendar(days_by_symbol: dict) -> np.ndarray:
+    """Sessions (int64 epoch days) to check the stored bars against."""
+    inferred = infer_calendar(days_by_symbol)
+    if not len(inferred):
+        return inferred
+    official = trading_calendar.sessions_between(np.datetime64(int(inferred[0]), 'D'),
+                                                  np.datetime64(int(inferred[-1]), 'D'))
+    official = official[trading_calendar.is_known(official)].astype(np.int64)
+    inferred = inferred[~trading_calendar.is_known(inferred.astype('datetime64[D]'))]
+    return np.union1d(inferred, official)
+
+
+def missing_sessions(days: np.ndarray, calendar: np.ndarray) -> np.ndarray:
+    """Sessions between the first and last bar of `days` that have no bar."""
+    if not len(days):
+        return np.empty(0, dtype=np.int64)
+    inside = calendar[(calendar > days.min()) & (calendar < days.max())]
+    return inside[~np.isin(inside, days)]
+
+
+def plan_ranges(anomaly_days: np.ndarray, merge_gap: int = MERGE_GAP_DAYS) -> list:
+    """Merge anomaly dates (epoch days) into (start, end) date ranges, joining those less than merge_gap apart."""
+    days = np.unique(anomaly_days)
+    if not len(days):
+        return []
+    breaks = np.flatnonzero(np.diff(days) >= merge_gap)
+    starts = np.concatenate([[days[0]], days[breaks + 1]])
+    ends = np.concatenate([days[breaks], [days[-1]]])
+    as_date = lambda d: np.datetime64(int(d), 'D').astype(object)
+    return [(as_date(s), as_date(e)) for s, e in zip(starts, ends)]
+
+
+class IntegrityReport:
+    def __init__(self, anomalies: pd.DataFrame, plan: dict, calendar: np.ndarray):
+        self.anomalies = anomalies
+        self.plan = plan  # {symbol: [{'start': date, 'end': date, 'kinds': [...]}]}
+        self.calendar = calendar
+
+    def counts(self) -> dict:
+        return self.anomalies['kind'].value_counts().reindex(KINDS, fill_value=0).to_dict()
+
+    def plan_json(self) -> dict:
+        return {symbol: [{'start': r['start'].isoformat(), 'end': r['end'].isoformat(), 'kinds': r['kinds']}
+                         for r in ranges] for symbol, ranges in self.plan.items()}
+
+    def __str__(self):
+        ranges = sum(len(r) for r in self.plan.values())
+        return f"< IntegrityReport | Anomalies {len(self.anomalies)} | Symbols {len(self.plan)} | Ranges {ranges} >"
+
+
+def scan(symbols: List[str], workers: int = SCAN_WORKERS, batch_size: int = SCAN_BATCH_SIZE) -> IntegrityReport:
+    """Check every symbol and build the repair plan."""
+    symbols = sorted(set(symbols))
+    batches = [symbols[i:i + batch_size] for i in range(0, len(symbols), max(1, batch_size))]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(batches) <= 1:
+        checked = [item for batch in batches for item in _check_batch(batch)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+            checked = [item for batch in pool.map(_check_batch, batches) for item in batch]
+
+    rows = []
+    days_by_symbol = {}
+    for symbol, anomalies, days in checked:
+        rows.extend(anomalies)
+        if days is not None:
+            days_by_symbol[symbol] = days
+    calendar = session_calendar(days_by_symbol)
+    for symbol, days in days_by_symbol.items():
+        for day in missing_sessions(days, calendar):
+            rows.append((symbol, str(np.datetime64(int(day), 'D')), 'missing_session', ''))
+
+    anomalies = pd.DataFrame(rows, columns=ANOMALY_COLUMNS).sort_values(['stock', 'date'], kind='stable') \
+        .reset_index(drop=True)
+    plan = {}
+    for symbol, group in anomalies.groupby('stock', sort=True):
+        days = group['date'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+        ranges = []
+        for start, end in plan_ranges(days):
+            inside = group[(group['date'] >= start.isoformat()) & (group['date'] <= end.isoformat())]
+            ranges.append({'start': start, 'end': end, 'kinds': sorted(set(inside['kind']))})
+        plan[symbol] = ranges
+    return IntegrityReport(anomalies, plan, calendar)
+
+
+def repair(plan: dict, skip=lambda symbol, start, end: False, on_result=None) -> dict:
+    """
+    Re-fetch every range of `plan` ({symbol: [{'start', 'end', ...}]}) and count the outcomes.
+    `skip(symbol, start, end)` leaves a range out, `on_result(symbol, start, end, status, message)` sees each outcome.
+    """
+    counts = {}
+    with manifest.batch():
+        for symbol, ranges in plan.items():
+            stock_data = StockData(symbol)
+            for r in ranges:
+                start, end = r['start'], r['end']
+                if isinstance(start, str):
+                    start, end = date.fromisoformat(start), date.fromisoformat(end)
+                if skip(symbol, start, end):
+                    counts['skipped'] = counts.get('skipped', 0) + 1
+                    continue
+                status, message = stock_data.refetch(start, end)
+                counts[status] = counts.get(status, 0) + 1
+                if on_result is not None:
+                    on_result(symbol, start, end, status, message)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the stored price files and plan or run repairs.")
+    parser.add_argument('command', choices=['scan', 'repair'])
+    parser.add_argument('--stocks-file', default=str(STOCKS_FILE), help="File with one symbol per line")
+    parser.add_argument('--workers', type=int, default=SCAN_WORKERS)
+    parser.add_argument('--plan', help="Write the repair plan to (scan) or read it from (repair) this JSON file")
+    parser.add_argument('--anomalies', help="Write every anomaly as CSV to this file")
+    args = parser.parse_args()
+
+    if args.command == 'repair':
+        if not args.plan:
+            parser.error("repair needs --plan")
+        with open(args.plan) as f:
+            plan = json.load(f)
+        counts = repair(plan)
+        for status, count in counts.items():
+            print(f"{status}: {count}")
+        if counts.get('repaired'):
+            from dataset import publish
+            print(f"Published dataset version {publish()}")
+        return 0
+
+    with open(args.stocks_file) as f:
+        symbols = [line.strip().upper() for line in f if line.strip()]
+    report = scan(symbols, workers=args.workers)
+    print(report)
+    for kind, count in report.counts().items():
+        print(f"  {kind}: {count}")
+    if args.anomalies:
+        report.anomalies.to_csv(args.anomalies, index=False)
+    if args.plan:
+        with open(args.plan, 'w') as f:
+            json.dump(report.plan_json(), f, indent=1)
+    else:
+        for symbol, ranges in report.plan_json().items():
+            print(symbol, ', '.join(f"{r['start']}..{r['end']} ({'/'.join(r['kinds'])})" for r in ranges))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Raw price ledger and corporate-action adjustment.
+
+Downloads are stored twice: the adjusted series in DATA_DIR that everything
+reads, and here the raw OHLCV bars exactly as NSE returned them plus the
+parsed splits and bonuses. Adjusted prices are derived from the two by one
+backward cumulative product of the action ratios, so a change to the
+adjustment rules is a local `python ledger.py readjust`, not a re-download.
+"""
+import argparse
+import ast
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from config import RAW_DIR
+from storage import get_storage
+
+ACTION_COLUMNS = ['ex_date', 'kind', 'ratio', 'subject']
+ADJUSTMENT = 'adjustment'  # Kind of the actions derived from a bhavcopy PREV_CLOSE
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close']
+SPLIT_PATTERN = r'From Rs ([\d\.]+)[^\d]+To (Re|Rs) ([\d\.]+)'
+BONUS_PATTERN = r'Bonus (\d+):(\d+)'
+
+
+def _cell_records(cell) -> list:
+    """The action dicts in one CA cell, which holds nan, a dict, a list of dicts or their repr."""
+    if isinstance(cell, str):
+        if not cell.strip():
+            return []
+        try:
+            cell = ast.literal_eval(cell)
+        except (ValueError, SyntaxError):
+            return []
+    if isinstance(cell, dict):
+        cell = [cell]
+    if not isinstance(cell, list):
+        return []
+    return [ca for ca in cell if isinstance(ca, dict)]
+
+
+def parse_actions(ca: pd.Series) -> pd.DataFrame:
+    """
+    Splits and bonuses found in a CA column, one row per action (ACTION_COLUMNS).
+    `ratio` is what prices before `ex_date` are divided by and volumes multiplied by.
+    """
+    records = []
+    parsed = {}  # The same repr repeats across rows, each is only evaluated once
+    for cell in ca.dropna():
+        if isinstance(cell, str):
+            if cell not in parsed:
+                parsed[cell] = _cell_records(cell)
+            records.extend(parsed[cell])
+        else:
+            records.extend(_cell_records(cell))
+    if not records:
+        return pd.DataFrame(columns=ACTION_COLUMNS)
+
+    raw = pd.DataFrame.from_records(records).reindex(columns=['subject', 'exDate'])
+    subject = raw['subject'].fillna('').astype(str)
+    ex_date = pd.to_datetime(raw['exDate'], errors='coerce', format='mixed')
+    split = subject.str.extract(SPLIT_PATTERN)
+    bonus = subject.str.extract(BONUS_PATTERN)
+    from_value = pd.to_numeric(split[0], errors='coerce')
+    to_value = pd.to_numeric(split[2], errors='coerce')
+    bonus_num = pd.to_numeric(bonus[0], errors='coerce')
+    bonus_den = pd.to_numeric(bonus[1], errors='coerce')
+
+    is_split = subject.str.contains('Face Value Split', regex=False)
+    is_bonus = ~is_split & subject.str.contains('Bonus', regex=False)
+    split_ok = is_split & (from_value > 0) & (to_value > 0) & (from_value != to_value)
+    bonus_ok = is_bonus & (bonus_den > 0)
+    ratio = np.where(split_ok, from_value / to_value, (bonus_num + bonus_den) / bonus_den)
+    keep = ((split_ok | bonus_ok) & ex_date.notna()).to_numpy()
+    actions = pd.DataFrame({
+        'ex_date': ex_date[keep].to_numpy(),
+        'kind': np.where(split_ok, 'split', 'bonus')[keep],
+        'ratio': ratio[keep],
+        'subject': subject[keep].to_numpy(),
+    })
+    return actions.drop_duplicates(['ex_date', 'kind', 'ratio']).sort_values('ex_date', kind='stable') \
+        .reset_index(drop=True)
+
+
+def adjustment_factors(dates, actions: pd.DataFrame) -> np.ndarray:
+    """
+    Cumulative adjustment factor of every bar: the product of the ratios of all
+    actions whose ex-date is after the bar, from one backward cumulative product.
+    """
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    if not len(actions):
+        return np.ones(len(dates))
+    order = np.argsort(actions['ex_date'].to_numpy(dtype='datetime64[ns]'), kind='stable')
+    ex_dates = actions['ex_date'].to_numpy(dtype='datetime64[ns]')[order]
+    ratios = actions['ratio'].to_numpy(dtype=np.float64)[order]
+    after = np.append(np.cumprod(ratios[::-1])[::-1], 1.0)
+    return after[np.searchsorted(ex_dates, dates, side='right')]
+
+
+def adjust(df: pd.DataFrame, actions: pd.DataFrame) -> pd.DataFrame:
+    """Adjusted copy of the raw bars in `df`."""
+    df = df.copy()
+    if not len(actions):
+        return df
+    factors = adjustment_factors(df.index.values, actions)
+    df[PRICE_COLUMNS] = df[PRICE_COLUMNS].to_numpy(dtype=np.float64) / factors[:, None]
+    df['Volume'] = df['Volume'].to_numpy() * factors
+    return df
+
+
+def _action_key(action) -> tuple:
+    return pd.Timestamp(action['ex_date']).date().isoformat(), action['kind'], float(action['ratio'])
+
+
+class Ledger:
+    def __init__(self, stock: str, root=RAW_DIR):
+        self.stock = stock
+        self.root = root
+        self.storage = get_storage()
+        file_safe_symbol = stock.replace('&', '-')
+        self.raw_path = root / f"{file_safe_symbol}{self.storage.suffix}"
+        self.actions_path = root / f"{file_safe_symbol}.actions.json"
+
+    def load_raw(self):
+        """Raw OHLCV bars, None if nothing has been recorded."""
+        if not self.raw_path.exists():
+            return None
+        return self.storage.read(self.raw_path)
+
+    def load_actions(self) -> pd.DataFrame:
+        try:
+            with open(self.actions_path) as f:
+                actions = pd.DataFrame(json.load(f), columns=ACTION_COLUMNS)
+        except FileNotFoundError:
+            return pd.DataFrame(columns=ACTION_COLUMNS)
+        actions['ex_date'] = pd.to_datetime(actions['ex_date'])
+        return actions
+
+    def record(self, raw_df: pd.DataFrame, actions: pd.DataFrame) -> pd.DataFrame:
+        """Store downloaded raw bars and their actions. Returns the actions not seen before."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        stored = self.load_raw()
+        if stored is None:
+            self.storage.write(self.raw_path, raw_df)
+        elif raw_df.index.min() > stored.index.max():
+            if not self.storage.append(self.raw_path, raw_df[stored.columns]):
+                self.storage.write(self.raw_path, pd.concat([stored, raw_df]))
+        else:
+            merged = pd.concat([stored, raw_df])
+            merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+            self.storage.write(self.raw_path, merged)
+
+        known = self.load_actions()
+        known_keys = {_action_key(action) for _, action in known.iterrows()}
+        # An adjustment from a bhavcopy PREV_CLOSE covers every action of its ex-date, so it and
+        # the splits and bonuses of a CA column are never both applied on one date
+        adjustment_dates = {key[0] for key in known_keys if key[1] == ADJUSTMENT}
+        action_dates = {key[0] for key in known_keys if key[1] != ADJUSTMENT}
+
+        def is_new(key):
+            if key in known_keys:
+                return False
+            return key[0] not in (action_dates if key[1] == ADJUSTMENT else adjustment_dates)
+        new = actions[[is_new(_action_key(action)) for _, action in actions.iterrows()]]
+        if len(new):
+            self._write_actions(pd.concat([known, new]).sort_values('ex_date', kind='stable'))
+        return new.reset_index(drop=True)
+
+    def _write_actions(self, actions: pd.DataFrame):
+        records = [
+            {'ex_date': pd.Timestamp(a['ex_date']).date().isoformat(), 'kind': a['kind'], 'ratio': float(a['ratio']),
+             'subject': a['subject']}
+            for _, a in actions.iterrows()
+        ]
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.actions-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(records, f, indent=1)
+            os.replace(tmp, self.actions_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def adjusted(self):
+        """Adjusted bars derived from the ledger, None if there are no raw bars."""
+        raw = self.load_raw()
+        if raw is None:
+            return None
+        return adjust(raw, self.load_actions())
+
+
+def readjust(symbols) -> dict:
+    """
+    Re-derive the stored adjusted series of `symbols` from their ledgers.
+    Symbols whose ledger does not reach back to the first stored bar (stored
+    before the ledger existed) are left as they are.
+    """
+    # Imported here, data imports this module to record downloads
+    from data import StockData, add_moving_averages, to_arrays
+    from events import update_event_index
+    from manifest import manifest
+    counts = {'readjusted': 0, 'no_ledger': 0, 'partial_ledger': 0}
+    with manifest.batch():
+        for symbol in symbols:
+            adjusted = Ledger(symbol).adjusted()
+            if adjusted is None:
+                counts['no_ledger'] += 1
+                continue
+            stock_data = StockData(symbol)
+            stored = stock_data.load()
+            if stored is not None and stored.index.min() < adjusted.index.min():
+                counts['partial_ledger'] += 1
+                continue
+            adjusted = add_moving_averages(adjusted)
+            stock_data.save(adjusted)
+            update_event_index(symbol, to_arrays(adjusted), rebuild=True)
+            counts['readjusted'] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the raw ledger or re-derive adjusted prices from it.")
+    parser.add_argument('command', choices=['readjust', 'actions'])
+    parser.add_argument('symbols', nargs='*', help="Symbols to process (default: the whole universe)")
+    args = parser.parse_args()
+    if args.symbols:
+        symbols = [symbol.upper() for symbol in args.symbols]
+    else:
+        from price_cache import universe
+        symbols = universe()
+    if args.command == 'readjust':
+        counts = readjust(symbols)
+        for status, count in counts.items():
+            print(f"{status}: {count}")
+        if counts['readjusted']:
+            from dataset import publish
+            print(f"Published dataset version {publish()}")
+    else:
+        for symbol in symbols:
+            actions = Ledger(symbol).load_actions()
+            for _, action in actions.iterrows():
+                print(f"{symbol} {action['ex_date'].date()} {action['kind']} x{action['ratio']:g}  {action['subject']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
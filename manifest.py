@@ -0,0 +1,147 @@
+"""
+Manifest of the stored price files.
+
+One small JSON file in DATA_DIR records, per symbol, the first and last date,
+row count and checksum of the stored bars, the file version they were taken
+from, and the outcome of the last sync. Freshness checks read it instead of
+loading every file. Each write rewrites it through a temp file and
+os.replace, so readers always see a complete manifest.
+
+Writers take an exclusive flock on a lock file next to it and merge their
+changes into the manifest as it is on disk, so the sync loop and the CLIs do
+not lose each other's entries. Inside `batch()` changes are kept in memory
+(and seen by lookups) and written once at the end, instead of rewriting the
+whole manifest for every symbol. Entries left unwritten by a crash are
+rebuilt from the files, whose version no longer matches.
+"""
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from config import MANIFEST_FILE
+
+LOCK_SUFFIX = '.lock'
+
+
+class Manifest:
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self._entries = {}
+        self._stat = None
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._pending = {}  # symbol: (replace the stored entry, fields or None to remove it)
+
+    def _stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # Unreadable manifest, it is rebuilt entry by entry from the files
+            return {}
+
+    def _stored(self) -> dict:
+        """Entries on disk, re-read only when the file changed."""
+        key = self._stat_key()
+        if key != self._stat:
+            self._entries = self._read()
+            self._stat = key
+        return self._entries
+
+    def entries(self) -> dict:
+        """All entries by symbol, with the changes of a running batch."""
+        with self._lock:
+            return self._apply(self._stored(), self._pending) if self._pending else self._stored()
+
+    def get(self, symbol: str):
+        with self._lock:
+            entry = self._stored().get(symbol)
+            if symbol not in self._pending:
+                return entry
+            replace, fields = self._pending[symbol]
+            if fields is None:
+                return None
+            return dict(fields) if replace else {**(entry or {}), **fields}
+
+    @staticmethod
+    def _apply(entries: dict, changes: dict) -> dict:
+        entries = dict(entries)
+        for symbol, (replace, fields) in changes.items():
+            if fields is None:
+                entries.pop(symbol, None)
+            else:
+                entries[symbol] = dict(fields) if replace else {**entries.get(symbol, {}), **fields}
+        return entries
+
+    def _change(self, symbol: str, fields):
+        with self._lock:
+            if fields is None:
+                self._pending[symbol] = (True, None)
+            else:
+                replace, pending = self._pending.get(symbol, (False, {}))
+                self._pending[symbol] = (replace, {**(pending or {}), **fields})
+            if not self._batches:
+                self._flush()
+
+    def update(self, symbol: str, **fields):
+        """Merge `fields` into the entry for `symbol` and write the manifest (at the end of a batch)."""
+        self._change(symbol, fields)
+
+    def remove(self, symbol: str):
+        if self.get(symbol) is not None:
+            self._change(symbol, None)
+
+    def record_sync(self, symbol: str, status: str):
+        self.update(symbol, status=status, synced_at=datetime.now().isoformat(timespec='seconds'))
+
+    @contextmanager
+    def batch(self):
+        """Write the changes made in the block, from any thread, to the manifest once at its end."""
+        with self._lock:
+            self._batches += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batches -= 1
+                if not self._batches and self._pending:
+                    self._flush()
+
+    def _flush(self):
+        """Merge the pending changes into the manifest on disk, with self._lock held."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(self.path.name + LOCK_SUFFIX), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self._apply(self._read(), self._pending)
+                self._write(entries)
+                self._entries = entries
+                self._stat = self._stat_key()
+                self._pending = {}
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self, entries: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix='.manifest-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, sort_keys=True)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+manifest = Manifest()
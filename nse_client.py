@@ -0,0 +1,146 @@
+"""
+Pooled HTTP client for NSE.
+
+Keeps NSE_SESSIONS requests sessions, each with its own keep-alive connection
+pool and NSE cookies, and hands one to a request at a time, so concurrent
+sync threads never share a session and a TLS handshake or a cookie fetch is
+paid once per session instead of once per call. Cookies are fetched again
+when they are older than NSE_COOKIE_TTL, and once more when NSE answers a
+request with an error page. Worker processes forked from a process that used
+the client get a new pool on their first request.
+
+Every request, cookie fetches included, takes a token from the NSE rate
+limiter.
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from config import NSE_SESSIONS, NSE_COOKIE_TTL
+from rate_limit import nse_limiter
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "*/*",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Referer": "https://www.nseindia.com",
+    "Connection": "keep-alive",
+}
+COOKIE_URL = "https://www.nseindia.com/option-chain"
+TIMEOUT = 20
+REJECTED_STATUS = (401, 403)
+
+
+class NseClient:
+    def __init__(self, sessions: int = NSE_SESSIONS, cookie_ttl: float = NSE_COOKIE_TTL, limiter=nse_limiter):
+        self.sessions = sessions
+        self.cookie_ttl = cookie_ttl
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.requests = 0
+        self.failures = 0
+        self.cookie_refreshes = 0
+        self.retries = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        session.verify = False
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2)
+        session.mount('https://', adapter)
+        session.cookies_at = None
+        return session
+
+    def _pool(self) -> queue.Queue:
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # Sessions and their sockets are not shared with a parent process
+                    idle = queue.LifoQueue()
+                    for _ in range(self.sessions):
+                        idle.put(self._new_session())
+                    self._idle = idle
+                    self._reset_counters()
+                    self._pid = pid
+        return self._idle
+
+    @contextmanager
+    def _session(self):
+        idle = self._pool()
+        session = idle.get()
+        try:
+            yield session
+        finally:
+            idle.put(session)
+
+    def _get(self, session: requests.Session, url: str) -> requests.Response:
+        self.limiter.acquire()
+        started = time.monotonic()
+        try:
+            return session.get(url, timeout=TIMEOUT)
+        except requests.RequestException:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.requests += 1
+                self.latency += elapsed
+                self.max_latency = max(self.max_latency, elapsed)
+
+    def _refresh_cookies(self, session: requests.Session):
+        session.cookies.clear()
+        self._get(session, COOKIE_URL)
+        session.cookies_at = time.monotonic()
+        with self._lock:
+            self.cookie_refreshes += 1
+
+    def get_json(self, url: str):
+        """JSON payload of an NSE API url, with cookies fetched first when the session's are missing or old."""
+        with self._session() as session:
+            if session.cookies_at is None or time.monotonic() - session.cookies_at > self.cookie_ttl:
+                self._refresh_cookies(session)
+            response = self._get(session, url)
+            if response.status_code not in REJECTED_STATUS:
+                try:
+                    return response.json()
+                except ValueError:
+                    pass
+            # An error page instead of JSON, usually expired cookies: fetch new ones and try once more
+            with self._lock:
+                self.retries += 1
+            self._refresh_cookies(session)
+            return self._get(session, url).json()
+
+    def get_text(self, url: str) -> str:
+        """Body of a file url (the archives need no cookies). Raises requests.HTTPError for a missing file."""
+        with self._session() as session:
+            response = self._get(session, url)
+            response.raise_for_status()
+            return response.text
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'cookie_refreshes': self.cookie_refreshes,
+                'retries': self.retries,
+                'mean_latency': round(self.latency / self.requests, 3) if self.requests else None,
+                'max_latency': round(self.max_latency, 3),
+            }
+
+
+nse_client = NseClient()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Date x symbol panel of the stored prices.
+
+Every field (Open, High, Low, Close, Volume and the moving averages) is one
+float64 matrix with a row per trading date and a column per symbol, NaN where
+a symbol has no bar. A row is a cross-section ("all closes on a date") and a
+column is one symbol's history, both read as views of the memory-mapped file.
+
+meta.json names the current generation of the files along with the date and
+symbol counts, and is replaced atomically. A rebuild writes a new generation.
+An update only appends rows for new dates to the current files, past the row
+count readers map, and publishes them with a new meta.json; any change to a
+published row (a readjusted history, a bar on a past date) is a rebuild. A
+crash mid-update leaves the published rows as they were.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from config import PANEL_DIR
+from data import StockData, data_checksum
+from price_cache import COLUMNS, universe
+
+FIELDS = COLUMNS
+META_FILE = 'meta.json'
+
+
+def _field_path(root, field: str, generation: int):
+    return root / f"{field}.{generation}.f8"
+
+
+def _dates_path(root, generation: int):
+    return root / f"dates.{generation}.i8"
+
+
+class Panel:
+    def __init__(self, root, meta: dict):
+        self.root = root
+        self.meta = meta
+        self.generation = meta['generation']
+        self.symbols = meta['symbols']
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        shape = (meta['n_dates'], len(self.symbols))
+        self.dates = np.memmap(_dates_path(root, self.generation), dtype=np.int64, mode='r',
+                               shape=(shape[0],)).view('datetime64[D]') if shape[0] else np.empty(0, 'datetime64[D]')
+        self.fields = {
+            field: np.memmap(_field_path(root, field, self.generation), dtype=np.float64, mode='r', shape=shape)
+            if shape[0] and shape[1] else np.empty(shape)
+            for field in FIELDS
+        }
+
+    @classmethod
+    def open(cls, root=PANEL_DIR):
+        """The published panel, None if none has been built."""
+        try:
+            with open(root / META_FILE) as f:
+                return cls(root, json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def __contains__(self, symbol: str):
+        return symbol in self.index
+
+    def __str__(self):
+        return f"< Panel {self.generation} | Dates {len(self.dates)} | Symbols {len(self.symbols)} >"
+
+    def row(self, date) -> int:
+        """Row of `date`, KeyError if it is not a trading date in the panel."""
+        date = np.datetime64(date, 'D')
+        i = int(np.searchsorted(self.dates, date))
+        if i == len(self.dates) or self.dates[i] != date:
+            raise KeyError(f"{date} is not in the panel")
+        return i
+
+    def cross_section(self, field: str, date) -> pd.Series:
+        """`field` of every symbol on `date`, NaN for symbols without a bar."""
+        return pd.Series(self.fields[field][self.row(date)], index=self.symbols, name=str(np.datetime64(date, 'D')))
+
+    def frame(self, field: str) -> pd.DataFrame:
+        """`field` as a dates x symbols DataFrame over the mapped matrix."""
+        return pd.DataFrame(self.fields[field], index=pd.DatetimeIndex(self.dates, name='Date'), columns=self.symbols,
+                            copy=False)
+
+    def series(self, symbol: str):
+        """
+        Bars of `symbol` as a dict of arrays keyed like StockData columns plus 'Date', None if it is not in the panel.
+        The arrays are views of its column from its first to its last bar; a
+        symbol with missing bars inside that range gets compacted copies instead.
+        """
+        i = self.index.get(symbol)
+        if i is None:
+            return None
+        first, last, bars = self.meta['ranges'][symbol]
+        rows = slice(first, last + 1)
+        data = {field: values[rows, i] for field, values in self.fields.items()}
+        data['Date'] = self.dates[rows]
+        if last + 1 - first != bars:
+            present = ~np.isnan(data['Close'])
+            data = {name: values[present] for name, values in data.items()}
+        return data
+
+
+def _write_meta(root, meta: dict):
+    fd, tmp = tempfile.mkstemp(dir=root, prefix='.meta-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, root / META_FILE)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _remove_generations(root, keep: int):
+    for path in root.iterdir():
+        parts = path.name.split('.')
+        if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) < keep - 1:
+            # The previous generation stays for readers still mapping it
+            path.unlink(missing_ok=True)
+
+
+def _range(rows: np.ndarray) -> list:
+    return [int(rows[0]), int(rows[-1]), len(rows)]
+
+
+def _load(symbols):
+    frames = {}
+    for symbol in symbols:
+        df = StockData(symbol).load()
+        if df is not None:
+            frames[symbol] = df
+    return frames
+
+
+def build(symbols, root=PANEL_DIR) -> Panel:
+    """Write a new generation of the panel for `symbols` from the price store and publish it."""
+    root.mkdir(parents=True, exist_ok=True)
+    previous = Panel.open(root)
+    generation = previous.generation + 1 if previous is not None else 1
+    frames = _load(sorted(set(symbols)))
+    names = sorted(frames)
+    day_index = {symbol: df.index.values.astype('datetime64[D]') for symbol, df in frames.items()}
+    dates = np.unique(np.concatenate(list(day_index.values()))) if frames else np.empty(0, 'datetime64[D]')
+    shape = (len(dates), len(names))
+
+    dates.astype(np.int64).tofile(_dates_path(root, generation))
+    ranges, checksums = {}, {}
+    rows = {symbol: np.searchsorted(dates, day_index[symbol]) for symbol in names}
+    for field in FIELDS:
+        matrix = np.full(shape, np.nan)
+        for i, symbol in enumerate(names):
+            matrix[rows[symbol], i] = frames[symbol][field].to_numpy(dtype=np.float64)
+        matrix.tofile(_field_path(root, field, generation))
+    for symbol in names:
+        ranges[symbol] = _range(rows[symbol])
+        checksums[symbol] = data_checksum(frames[symbol])
+
+    _write_meta(root, {'generation': generation, 'n_dates': shape[0], 'symbols': names,
+                       'ranges': ranges, 'checksums': checksums})
+    _remove_generations(root, generation)
+    return Panel.open(root)
+
+
+def update(symbols, root=PANEL_DIR) -> Panel:
+    """
+    Bring the panel up to date with the price store by appending rows for new dates.
+    Falls back to a rebuild when the symbols change or the stored data of a
+    symbol differs from the panel on a date it already has.
+    """
+    panel = Panel.open(root)
+    symbols = sorted(set(symbols))
+    if panel is None:
+        return build(symbols, root)
+    stored = {symbol: StockData(symbol).manifest_entry() for symbol in symbols}
+    if sorted(symbol for symbol, entry in stored.items() if entry is not None) != panel.symbols:
+        return build(symbols, root)
+    changed = [symbol for symbol in panel.symbols
+               if stored[symbol]['checksum'] != panel.meta['checksums'].get(symbol)]
+    if not changed:
+        return panel
+
+    frames = _load(changed)
+    if len(frames) != len(changed):
+        return build(symbols, root)
+    last = panel.dates[-1] if len(panel.dates) else None
+    day_index = {symbol: df.index.values.astype('datetime64[D]') for symbol, df in frames.items()}
+    new_dates = np.unique(np.concatenate([days[days > last] if last is not None else days
+                                          for days in day_index.values()]))
+    dates = np.concatenate([np.asarray(panel.dates), new_dates])
+    rows = {symbol: np.searchsorted(dates, days) for symbol, days in day_index.items()}
+    meta, index = panel.meta, panel.index
+    generation, n_symbols, old_n = panel.generation, len(panel.symbols), len(panel.dates)
+    for symbol, days in day_index.items():
+        if (rows[symbol] >= len(dates)).any() or (dates[rows[symbol]] != days).any():
+            return build(symbols, root)
+        # Published rows are never rewritten in place
+        past = rows[symbol] < old_n
+        if int(past.sum()) != (meta['ranges'][symbol][2] if symbol in meta['ranges'] else 0):
+            return build(symbols, root)
+        for field in FIELDS:
+            values = frames[symbol][field].to_numpy(dtype=np.float64)[past]
+            if not np.array_equal(panel.fields[field][rows[symbol][past], index[symbol]], values, equal_nan=True):
+                return build(symbols, root)
+
+    shape = (len(dates), n_symbols)
+    if len(new_dates):
+        with open(_dates_path(root, generation), 'r+b') as f:
+            # Drop rows a failed update may have left past the published count
+            f.truncate(old_n * 8)
+            f.seek(0, os.SEEK_END)
+            f.write(new_dates.astype(np.int64).tobytes())
+        for field in FIELDS:
+            path = _field_path(root, field, generation)
+            with open(path, 'r+b') as f:
+                f.truncate(old_n * n_symbols * 8)
+                f.seek(0, os.SEEK_END)
+                f.write(np.full((len(new_dates), n_symbols), np.nan).tobytes())
+            matrix = np.memmap(path, dtype=np.float64, mode='r+', shape=shape)
+            for symbol in frames:
+                new = rows[symbol] >= old_n
+                matrix[rows[symbol][new], index[symbol]] = frames[symbol][field].to_numpy(dtype=np.float64)[new]
+            matrix.flush()
+            del matrix
+    for symbol, df in frames.items():
+        meta['ranges'][symbol] = _range(rows[symbol])
+        meta['checksums'][symbol] = data_checksum(df)
+    meta['n_dates'] = shape[0]
+    _write_meta(root, meta)
+    return Panel.open(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, update or inspect the date x symbol panel.")
+    parser.add_argument('command', choices=['build', 'update', 'info'])
+    args = parser.parse_args()
+    if args.command == 'build':
+        print(f"Built {build(universe())}")
+    elif args.command == 'update':
+        print(f"Updated {update(universe())}")
+    else:
+        panel = Panel.open()
+        print(panel if panel is not None else "No panel built yet.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
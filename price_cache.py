@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Shared memory-mapped price cache.
+
+A snapshot is a directory of flat .npy columns holding every symbol's bars
+back to back, plus an offsets array marking where each symbol starts. It is
+built once after a sync and memory-mapped read-only by every gunicorn worker,
+so scans do no CSV parsing and the pages are shared between processes.
+
+The CURRENT file names the active snapshot. It is replaced atomically, and
+readers pick up the new snapshot on their next lookup, unless they pinned
+the one they started on.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+import numpy as np
+from config import PRICE_CACHE_DIR, MA_WINDOWS, STOCKS_FILE, MASTER_STOCKS_FILE
+from data import StockData, ma_column
+
+COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume'] + [ma_column(w) for w in MA_WINDOWS]
+CURRENT_FILE = 'CURRENT'
+KEEP_SNAPSHOTS = 2
+
+
+class Snapshot:
+    def __init__(self, path, version: str):
+        self.path = path
+        self.version = version
+        with open(path / 'symbols.json') as f:
+            symbols = json.load(f)
+        self.index = {symbol: i for i, symbol in enumerate(symbols)}
+        self.offsets = np.load(path / 'offsets.npy')
+        self.dates = np.load(path / 'Date.npy', mmap_mode='r').view('datetime64[D]')
+        self.columns = {col: np.load(path / f'{col}.npy', mmap_mode='r') for col in COLUMNS}
+
+    def __contains__(self, symbol: str):
+        return symbol in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, symbol: str):
+        """Return a dict of read-only column views for `symbol` ('Date' included), or None."""
+        i = self.index.get(symbol)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        data = {col: values[start:end] for col, values in self.columns.items()}
+        data['Date'] = self.dates[start:end]
+        return data
+
+    def __str__(self):
+        return f"< Snapshot {self.version} | Symbols {len(self)} | Bars {self.offsets[-1]} >"
+
+
+class PriceCache:
+    """Per-process handle on the current snapshot, re-checked on every lookup."""
+
+    def __init__(self, root=PRICE_CACHE_DIR):
+        self.root = root
+        self._snapshot = None
+        self._snapshots = {}
+        self._pins = threading.local()
+
+    def current_version(self):
+        try:
+            with open(self.root / CURRENT_FILE) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def pinned(self, version):
+        """
+        Serve snapshot `version` to lookups in this thread for the duration of
+        the block, so a whole scan reads one snapshot even if a new one is
+        published meanwhile. `None` leaves lookups on the current snapshot.
+        """
+        previous = getattr(self._pins, 'version', None)
+        self._pins.version = version
+        try:
+            yield
+        finally:
+            self._pins.version = previous
+
+    def snapshot(self):
+        """Return the active (or pinned) Snapshot, or None if no snapshot has been built."""
+        version = getattr(self._pins, 'version', None) or self.current_version()
+        if version is None:
+            return None
+        snapshot = self._snapshots.get(version)
+        if snapshot is None:
+            try:
+                snapshot = Snapshot(self.root / version, version)
+            except (FileNotFoundError, ValueError):
+                # Snapshot removed between reading CURRENT and opening it
+                return self._snapshot
+            # Keep the snapshots a pinned reader may still be on, drop older ones
+            self._snapshots = {v: s for v, s in self._snapshots.items()
+                               if int(v) > int(version) - KEEP_SNAPSHOTS}
+            self._snapshots[version] = snapshot
+        if not getattr(self._pins, 'version', None):
+            self._snapshot = snapshot
+        return snapshot
+
+    def get(self, symbol: str):
+        snapshot = self.snapshot()
+        return snapshot.get(symbol) if snapshot is not None else None
+
+    def version_of(self, symbol: str):
+        """Snapshot version serving `symbol`, None if it is not cached."""
+        snapshot = self.snapshot()
+        if snapshot is None or symbol not in snapshot:
+            return None
+        return f"snapshot-{snapshot.version}"
+
+
+def _next_version(root) -> str:
+    versions = [int(p.name) for p in root.iterdir() if p.is_dir() and p.name.isdigit()]
+    return str(max(versions, default=0) + 1)
+
+
+def _publish(root, version: str):
+    fd, tmp = tempfile.mkstemp(dir=root, prefix='.current-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(version)
+    os.replace(tmp, root / CURRENT_FILE)
+
+
+def _prune(root, keep: str):
+    versions = sorted((int(p.name) for p in root.iterdir() if p.is_dir() and p.name.isdigit()), reverse=True)
+    for version in versions[KEEP_SNAPSHOTS:]:
+        if str(version) != keep:
+            # Workers still mapping an old snapshot keep their pages until they switch
+            shutil.rmtree(root / str(version), ignore_errors=True)
+
+
+def build_snapshot(symbols, root=PRICE_CACHE_DIR) -> str:
+    """Write a new snapshot of `symbols` from the price store, publish it and return its version."""
+    root.mkdir(parents=True, exist_ok=True)
+    names, offsets = [], [0]
+    parts = {col: [] for col in ['Date'] + COLUMNS}
+    for symbol in sorted(set(symbols)):
+        df = StockData(symbol).load()
+        if df is None:
+            continue
+        names.append(symbol)
+        offsets.append(offsets[-1] + len(df))
+        parts['Date'].append(df.index.values.astype('datetime64[D]').astype(np.int64))
+        for col in COLUMNS:
+            parts[col].append(df[col].to_numpy(dtype=np.float64))
+
+    tmp = tempfile.mkdtemp(dir=root, prefix='.build-')
+    try:
+        for col, chunks in parts.items():
+            dtype = np.int64 if col == 'Date' else np.float64
+            values = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+            np.save(os.path.join(tmp, f'{col}.npy'), values)
+        np.save(os.path.join(tmp, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+        with open(os.path.join(tmp, 'symbols.json'), 'w') as f:
+            json.dump(names, f)
+        version = _next_version(root)
+        os.rename(tmp, root / version)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    _publish(root, version)
+    _prune(root, version)
+    return version
+
+
+def universe():
+    symbols = set()
+    for path in (STOCKS_FILE, MASTER_STOCKS_FILE):
+        if path.exists():
+            with open(path) as f:
+                symbols.update(line.strip().upper() for line in f if line.strip())
+    return sorted(symbols)
+
+
+price_cache = PriceCache()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect the shared price cache.")
+    parser.add_argument('command', choices=['build', 'info'])
+    args = parser.parse_args()
+    if args.command == 'build':
+        version = build_snapshot(universe())
+        print(f"Published snapshot {version}: {price_cache.snapshot()}")
+    else:
+        snapshot = price_cache.snapshot()
+        print(snapshot if snapshot is not None else "No snapshot built yet.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
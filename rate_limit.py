@@ -0,0 +1,52 @@
+"""
+Token-bucket rate limiter for the NSE requests.
+
+The bucket holds up to `burst` tokens and refills at `rate` tokens per second.
+Every request takes one token, waiting for it when the bucket is empty, so
+any number of threads together stay under `rate` requests per second on
+average and never send more than `burst` back to back. `nse_limiter` is the
+process-wide bucket api.nsefetch takes from.
+"""
+import threading
+import time
+from config import NSE_REQUESTS_PER_SECOND, NSE_BURST
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Rate limit needs rate > 0 and burst >= 1, got {rate} and {burst}")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.waited = 0.0  # Seconds callers spent waiting for a token
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """Take one token, waiting until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    self.waited += waited
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'requests': self.requests,
+                    'waited': round(self.waited, 2)}
+
+
+nse_limiter = TokenBucket(NSE_REQUESTS_PER_SECOND, NSE_BURST)
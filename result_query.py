@@ -0,0 +1,92 @@
+"""
+Server-side sorting, symbol search and cursor pagination over scan results.
+"""
+import base64
+import hashlib
+import json
+from datetime import datetime
+from typing import List
+
+NUMERIC_KEYS = ('profit_margin', 'v20margin', 'ma', 'low_price', 'high_price')
+DATE_KEYS = ('low_date', 'high_date', 'buy_date')
+SORT_KEYS = ('stock',) + NUMERIC_KEYS + DATE_KEYS
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def parse_sort(sort: str):
+    """Split 'column-direction' (e.g. 'v20margin-desc') into (column, descending)."""
+    column, _, direction = (sort or 'stock-asc').rpartition('-')
+    if column not in SORT_KEYS or direction not in ('asc', 'desc'):
+        raise ValueError(f"Invalid sort {sort!r}, expected <key>-asc or <key>-desc with key in {SORT_KEYS}")
+    return column, direction == 'desc'
+
+
+def _sort_value(row: dict, column: str):
+    value = row[column]
+    if value is None:
+        return None
+    if column in DATE_KEYS:
+        return datetime.strptime(value, "%d-%b-%Y")
+    return value
+
+
+def sort_results(results: List[dict], sort: str) -> List[dict]:
+    """Sort by one key, ties broken by stock then low date. Missing values (no buy date) always go last."""
+    column, descending = parse_sort(sort)
+    present = [row for row in results if row[column] is not None]
+    missing = [row for row in results if row[column] is None]
+    present.sort(key=lambda row: (row['stock'], _sort_value(row, 'low_date')))
+    present.sort(key=lambda row: _sort_value(row, column), reverse=descending)
+    return present + missing
+
+
+def search(results: List[dict], prefix: str) -> List[dict]:
+    """Rows whose stock starts with `prefix` (case-insensitive)."""
+    if not prefix:
+        return results
+    prefix = prefix.strip().upper()
+    return [row for row in results if row['stock'].upper().startswith(prefix)]
+
+
+def fingerprint(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+
+def encode_cursor(offset: int, token: str) -> str:
+    raw = json.dumps({'o': offset, 't': token}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, token: str) -> int:
+    """Offset stored in `cursor`. Raises ValueError if it is malformed or was issued for another query or data version."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        offset = int(data['o'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed cursor")
+    if data.get('t') != token:
+        raise ValueError("Cursor does not match this query or the data has changed, start again without a cursor")
+    return offset
+
+
+def paginate(results: List[dict], sort: str, prefix: str = '', cursor: str = None, limit: int = DEFAULT_LIMIT,
+             token: str = '') -> dict:
+    """
+    One page of sorted, searched results.
+
+    `token` identifies the query and data version; cursors are only accepted
+    for the same token so a page never mixes two different result sets.
+    """
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    token = fingerprint(token, sort, (prefix or '').strip().upper())
+    rows = sort_results(search(results, prefix), sort)
+    offset = decode_cursor(cursor, token) if cursor else 0
+    page = rows[offset:offset + limit]
+    end = offset + len(page)
+    return {
+        'results': page,
+        'total': len(rows),
+        'next_cursor': encode_cursor(end, token) if end < len(rows) else None,
+    }
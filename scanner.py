@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Universe scan executor.
+
+Fans the V20 scan for a list of symbols out across a process pool in batches
+and merges the results back in the order the symbols were given. Used by the
+Flask /run route and runnable from the command line.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
+from algo import Algo, data_version
+from config import STOCKS_FILE, SCAN_WORKERS, SCAN_BATCH_SIZE
+from dataset import current_version
+from price_cache import price_cache
+from result_cache import result_cache
+
+
+class ScanResult:
+    def __init__(self, results: List[dict], errors: List[dict], elapsed: float, cached: int = 0, version: str = None):
+        self.results = results
+        self.errors = errors
+        self.elapsed = elapsed
+        self.cached = cached  # Symbols answered from the result cache
+        self.version = version  # Digest of the symbols and their data or dataset version, None without a cache
+
+    def __str__(self):
+        return (f"< ScanResult | Results {len(self.results)} | Errors {len(self.errors)} | "
+                f"Cached {self.cached} | {self.elapsed:.2f}s >")
+
+
+def scan_symbol(symbol: str, history: int, margin: int, filter_by_last_close: bool, last_close_margin: int):
+    """Run the V20 scan for one symbol. Returns (results, error) where error is None or a dict."""
+    try:
+        return Algo(symbol, history, margin, filter_by_last_close, last_close_margin).run_algo(), None
+    except Exception as e:
+        return [], {
+            'stock': symbol,
+            'type': type(e).__name__,
+            'error': str(e),
+            'traceback': traceback.format_exc(),
+        }
+
+
+def _scan_batch(symbols: List[str], params: tuple, snapshot: str = None):
+    with price_cache.pinned(snapshot):
+        return [scan_symbol(symbol, *params) for symbol in symbols]
+
+
+def _batches(symbols: List[str], batch_size: int):
+    return [symbols[i:i + batch_size] for i in range(0, len(symbols), batch_size)]
+
+
+def universe_version(symbols: List[str], versions: List[str]) -> str:
+    return hashlib.sha1(repr((symbols, versions)).encode()).hexdigest()
+
+
+def dataset_key(symbols: List[str], snapshot: str):
+    """Version of a universe from the published dataset version, None if no version has been published."""
+    version = current_version()
+    if version is None:
+        return None
+    return hashlib.sha1(repr((symbols, version, snapshot)).encode()).hexdigest()
+
+
+def iter_scan(symbols: List[str], history: int = 200, margin: int = 20, filter_by_last_close: bool = True,
+              last_close_margin: int = 5, workers: int = SCAN_WORKERS, batch_size: int = SCAN_BATCH_SIZE,
+              cache=result_cache, versions: List[str] = None, snapshot: str = None):
+    """
+    Scan every symbol and yield progress as batches complete.
+
+    Each item is a list of (position, results, error, cached) for the symbols
+    of one batch, where position is the symbol's index in `symbols`. Symbols
+    answered from `cache` come first in a single item; scanned batches follow
+    in the order they finish. Every symbol is read from price cache snapshot
+    `snapshot`, by default the one current when the scan starts.
+    """
+    symbols = list(symbols)
+    params = (history, margin, filter_by_last_close, last_close_margin)
+    snapshot = snapshot or price_cache.current_version()
+    if cache is not None and versions is None:
+        with price_cache.pinned(snapshot):
+            versions = [data_version(symbol) for symbol in symbols]
+
+    hits, pending = [], []
+    for i, symbol in enumerate(symbols):
+        cached = cache.get(('symbol', symbol, params, versions[i])) if cache is not None else None
+        if cached is None:
+            pending.append(i)
+        else:
+            hits.append((i, cached, None, True))
+    if hits:
+        yield hits
+
+    def done(positions, outcomes):
+        batch = []
+        for i, (symbol_results, error) in zip(positions, outcomes):
+            if error is None and cache is not None and versions[i] is not None:
+                cache.put(('symbol', symbols[i], params, versions[i]), symbol_results)
+            batch.append((i, symbol_results, error, False))
+        return batch
+
+    workers = workers or os.cpu_count() or 1
+    batches = _batches(pending, max(1, batch_size))
+    if workers == 1 or len(batches) <= 1:
+        for positions in batches:
+            yield done(positions, _scan_batch([symbols[i] for i in positions], params, snapshot))
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+        futures = {pool.submit(_scan_batch, [symbols[i] for i in positions], params, snapshot): positions
+                   for positions in batches}
+        try:
+            for future in as_completed(futures):
+                yield done(futures[future], future.result())
+        finally:
+            # Stop queued batches when the consumer goes away early
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_universe(symbols: List[str], history: int = 200, margin: int = 20, filter_by_last_close: bool = True,
+                  last_close_margin: int = 5, workers: int = SCAN_WORKERS, batch_size: int = SCAN_BATCH_SIZE,
+                  cache=result_cache):
+    """
+    Scan every symbol like scan_universe, yielding (symbols done, None) as
+    batches complete and (len(symbols), ScanResult) last.
+
+    The merged results are stored as the universe entry of `cache` when the
+    scan finishes without errors, so a streamed scan and the pages requested
+    after it share one entry.
+    """
+    started = time.time()
+    symbols = list(symbols)
+    params = (history, margin, filter_by_last_close, last_close_margin)
+    snapshot = price_cache.current_version()
+    version = versions = None
+    if cache is not None:
+        version = dataset_key(symbols, snapshot)
+        if version is None:
+            with price_cache.pinned(snapshot):
+                versions = [data_version(symbol) for symbol in symbols]
+            version = universe_version(symbols, versions)
+        universe_key = ('universe', params, version)
+        results = cache.get(universe_key)
+        if results is not None:
+            yield len(symbols), ScanResult(results, [], time.time() - started, cached=len(symbols), version=version)
+            return
+
+    per_symbol = [None] * len(symbols)
+    errors = []
+    cached = 0
+    done = 0
+    for batch in iter_scan(symbols, *params, workers=workers, batch_size=batch_size, cache=cache, versions=versions,
+                           snapshot=snapshot):
+        for i, symbol_results, error, from_cache in batch:
+            per_symbol[i] = symbol_results
+            cached += from_cache
+            if error is not None:
+                errors.append(error)
+        done += len(batch)
+        if done < len(symbols):
+            yield done, None
+
+    results = [row for symbol_results in per_symbol for row in symbol_results]
+    if cache is not None and not errors:
+        cache.put(universe_key, results)
+    yield len(symbols), ScanResult(results, errors, time.time() - started, cached=cached, version=version)
+
+
+def scan_universe(symbols: List[str], history: int = 200, margin: int = 20, filter_by_last_close: bool = True,
+                  last_close_margin: int = 5, workers: int = SCAN_WORKERS, batch_size: int = SCAN_BATCH_SIZE,
+                  cache=result_cache) -> ScanResult:
+    """
+    Scan every symbol and return a ScanResult.
+
+    Results are ordered by the position of their symbol in `symbols`, so the
+    output does not depend on which worker finished first. `workers=1` runs
+    the scan in the calling process. Results are looked up in `cache` per
+    universe and per symbol, keyed by the parameters and the data version,
+    and only the misses are scanned. Pass `cache=None` to always rescan.
+    Once a dataset version has been published the universe entry is keyed by
+    it, and a hit needs no per-symbol version lookups.
+    """
+    for _, scan in iter_universe(symbols, history, margin, filter_by_last_close, last_close_margin, workers,
+                                 batch_size, cache):
+        if scan is not None:
+            return scan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the V20 scan over a list of stocks.")
+    parser.add_argument('--stocks-file', default=str(STOCKS_FILE), help="File with one symbol per line")
+    parser.add_argument('--history', type=int, default=200)
+    parser.add_argument('--margin', type=int, default=20)
+    parser.add_argument('--no-filter-by-last-close', dest='filter_by_last_close', action='store_false')
+    parser.add_argument('--last-close-margin', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=SCAN_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=SCAN_BATCH_SIZE)
+    parser.add_argument('--json', action='store_true', help="Print results and errors as JSON")
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="Always rescan every symbol")
+    args = parser.parse_args()
+
+    with open(args.stocks_file) as f:
+        symbols = sorted(set(line.strip().upper() for line in f if line.strip()))
+
+    scan = scan_universe(symbols, args.history, args.margin, args.filter_by_last_close, args.last_close_margin,
+                         workers=args.workers, batch_size=args.batch_size,
+                         cache=result_cache if args.cache else None)
+    if args.json:
+        json.dump({'results': scan.results, 'errors': scan.errors, 'elapsed': scan.elapsed}, sys.stdout)
+        print()
+    else:
+        for r in scan.results:
+            print(f"{r['stock']:<15} v20 {r['v20margin']:>7}%  low {r['low_price']:>10} ({r['low_date']})  "
+                  f"high {r['high_price']:>10} ({r['high_date']})  buy {r['buy_date']}")
+        for e in scan.errors:
+            print(f"ERROR {e['stock']}: {e['type']}: {e['error']}", file=sys.stderr)
+        print(f"{len(symbols)} stocks, {len(scan.results)} results, {len(scan.errors)} errors in {scan.elapsed:.2f}s",
+              file=sys.stderr)
+    return 1 if scan.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Market-aware scheduler for continuous_sync.
+
+Decides which session a cycle syncs up to, in what order the stale symbols
+go, and when the next cycle runs.
+
+The target is the latest session whose end-of-day data NSE has published.
+Data for a session is expected from EOD_PUBLISH_TIME (IST) on that day; from
+then until it is out the loop polls every EOD_POLL_MINUTES, and otherwise it
+sleeps until the next session's publish time (at most SYNC_MAX_SLEEP_MINUTES,
+so symbols added to the lists are picked up).
+
+Stale symbols are synced by priority class: the `stocks` list the web app
+scans, then `master-stocks`, then backfills, symbols with no stored data
+whose initial download takes many requests. A symbol still stale after its
+sync waits RETRY_BASE_SECONDS before the next attempt, doubled after every
+further failure up to RETRY_MAX_SECONDS. The backoff starts over with each
+new target session.
+"""
+import argparse
+import sys
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+from config import EOD_PUBLISH_TIME, EOD_POLL_MINUTES, SYNC_MAX_SLEEP_MINUTES, RETRY_BASE_SECONDS, \
+    RETRY_MAX_SECONDS
+from trading_calendar import trading_calendar
+
+NSE_TZ = ZoneInfo('Asia/Kolkata')
+WEB, MASTER, BACKFILL = 0, 1, 2
+PRIORITY_NAMES = {WEB: 'web', MASTER: 'master', BACKFILL: 'backfill'}
+
+
+class SyncScheduler:
+    def __init__(self, calendar=trading_calendar, publish_time: str = EOD_PUBLISH_TIME,
+                 poll_minutes: float = EOD_POLL_MINUTES, max_sleep_minutes: float = SYNC_MAX_SLEEP_MINUTES,
+                 retry_base: float = RETRY_BASE_SECONDS, retry_max: float = RETRY_MAX_SECONDS):
+        self.calendar = calendar
+        self.publish_time = time.fromisoformat(publish_time)
+        self.poll = timedelta(minutes=poll_minutes)
+        self.max_sleep = timedelta(minutes=max_sleep_minutes)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.session = None
+        self._retries = {}  # symbol: (failures, due)
+
+    def now(self) -> datetime:
+        return datetime.now(NSE_TZ)
+
+    def publish_at(self, session: date) -> datetime:
+        """Time the end-of-day data of `session` is expected, in IST."""
+        return datetime.combine(session, self.publish_time, tzinfo=NSE_TZ)
+
+    def target(self, now: datetime = None, published=None) -> date:
+        """
+        Latest session whose data is out at `now`: today once past the publish time and, when
+        `published(day)` is given, once it confirms the data, otherwise the previous session.
+        """
+        now = now or self.now()
+        today = now.date()
+        if self.calendar.is_session(today) and now >= self.publish_at(today) and \
+                (published is None or published(today)):
+            return today
+        return self.calendar.previous_session(today)
+
+    def set_target(self, session: date):
+        """Sync toward `session`; a new session clears the backoff of the symbols that failed the last one."""
+        if session != self.session:
+            self.session = session
+            self._retries.clear()
+
+    def priority(self, symbol: str, web: set, has_data) -> int:
+        if not has_data(symbol):
+            return BACKFILL
+        return WEB if symbol in web else MASTER
+
+    def plan(self, symbols, web: set, has_data, now: datetime = None) -> dict:
+        """Stale `symbols` not waiting out a backoff as {priority: [symbols]}, in priority order."""
+        now = now or self.now()
+        classes = {WEB: [], MASTER: [], BACKFILL: []}
+        for symbol in sorted(symbols):
+            if not self.waiting(symbol, now):
+                classes[self.priority(symbol, web, has_data)].append(symbol)
+        return classes
+
+    def waiting(self, symbol: str, now: datetime = None) -> bool:
+        retry = self._retries.get(symbol)
+        return retry is not None and retry[1] > (now or self.now())
+
+    def succeeded(self, symbol: str):
+        self._retries.pop(symbol, None)
+
+    def failed(self, symbol: str, now: datetime = None) -> datetime:
+        """Put `symbol` in the retry queue and return when it is due again."""
+        failures = self._retries.get(symbol, (0, None))[0] + 1
+        delay = min(self.retry_base * 2 ** (failures - 1), self.retry_max)
+        due = (now or self.now()) + timedelta(seconds=delay)
+        self._retries[symbol] = (failures, due)
+        return due
+
+    def retries(self) -> dict:
+        return {symbol: due for symbol, (_, due) in self._retries.items()}
+
+    def next_wake(self, target: date, now: datetime = None) -> datetime:
+        """
+        When the next cycle should run: the first retry that falls due, and otherwise the next
+        publish time, or the next poll while today's data is late.
+        """
+        now = now or self.now()
+        today = now.date()
+        if self.calendar.is_session(today) and target < today:
+            publish = self.publish_at(today)
+            wake = publish if now < publish else now + self.poll
+        else:
+            wake = self.publish_at(self.calendar.next_session(today))
+        wake = min([wake, now + self.max_sleep] + [due for _, due in self._retries.values()])
+        return max(wake, now)
+
+
+sync_scheduler = SyncScheduler()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the sync target and the next scheduled cycle.")
+    parser.parse_args()
+    now = sync_scheduler.now()
+    target = sync_scheduler.target(now)
+    print(f"Now: {now:%Y-%m-%d %H:%M %Z}")
+    print(f"Target session: {target}")
+    print(f"Next cycle: {sync_scheduler.next_wake(target, now):%Y-%m-%d %H:%M %Z}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
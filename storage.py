@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+On-disk formats for the per-symbol price files.
+
+`csv` is the original text format. `columnar` is a typed binary file: a small
+header followed by each column stored contiguously with a fixed dtype, the
+dates as int64 days since the epoch. Loading it is a single read and no text
+parsing.
+
+Columnar layout:
+    magic (8 bytes) | nrows, capacity, header_len (int64 each) | JSON header
+    padded to 8 bytes | one block of `capacity` values per column
+
+The JSON header lists the columns as [name, dtype, decimals] triples, the
+index first. Only the first `nrows` values of each block are data. A float
+column whose values all have at most two decimals (raw prices, the rounded
+moving averages) is stored exactly as int32 hundredths with `decimals` 2 and
+NaN as the int32 minimum; `decimals` is null for columns stored as is.
+
+Files are written with STORAGE_HEADROOM spare rows so new bars are appended
+in place: the values go into the spare space and `nrows` is updated last.
+Compaction rewrites a file whose spare rows are running out.
+
+Whole-file writes of both formats go through a temp file and os.replace.
+Appends write only the new bars: atomically for columnar files (readers use
+the old `nrows` until it is updated), with a plain append and fsync for CSV. A CSV line left incomplete by an
+interrupted append is skipped on read, and the next update rewrites the file.
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from config import DATA_DIR, STORAGE, STORAGE_HEADROOM
+
+INDEX = 'Date'
+INDEX_DTYPE = 'datetime64[ns]'  # Both formats read the dates back at this resolution
+SCALED_DECIMALS = 2
+SCALED_NAN = np.iinfo(np.int32).min
+SCALED_MAX = np.iinfo(np.int32).max
+
+
+def replace_file(path, write, binary: bool = True):
+    """
+    Write a file with `write(f)` into a temp file next to `path` and move it over
+    `path`, so readers see either the old file or the complete new one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w', newline=None if binary else '') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _days(index: pd.DatetimeIndex) -> np.ndarray:
+    return index.values.astype('datetime64[D]').astype(np.int64)
+
+
+def _ends_with_newline(path) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+class CsvStorage:
+    name = 'csv'
+    suffix = '.csv'
+
+    def read(self, path) -> pd.DataFrame:
+        df = pd.read_csv(path, index_col=INDEX, parse_dates=True)
+        if not _ends_with_newline(path):
+            # The partial row of an append that was cut short
+            df = df.iloc[:-1]
+        df.index = df.index.astype(INDEX_DTYPE)
+        return df
+
+    def write(self, path, df: pd.DataFrame):
+        replace_file(path, lambda f: df.to_csv(f, date_format='%Y-%m-%d', index=True), binary=False)
+
+    def append(self, path, df: pd.DataFrame) -> bool:
+        """
+        Add the rows of `df` at the end of the file. False if its columns differ from the stored ones
+        or its last line is incomplete (an append cut short), and the whole file has to be written instead.
+        """
+        with open(path) as f:
+            stored_columns = f.readline().strip().split(',')
+        if stored_columns != [INDEX] + list(df.columns) or not _ends_with_newline(path):
+            return False
+
+        # Only the new rows are written, in one write at the end of the file. Unlike a
+        # rewrite this is not atomic, but a partial last line is never read or appended to
+        rows = df.to_csv(header=False, date_format='%Y-%m-%d', index=True, lineterminator='\n').encode()
+        with open(path, 'ab') as f:
+            f.write(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def needs_compaction(self, path) -> bool:
+        return False
+
+
+class ColumnarStorage:
+    name = 'columnar'
+    suffix = '.col'
+    MAGIC = b'V20COL\x00\x01'
+    PREAMBLE = struct.Struct('<8sqqq')
+
+    @staticmethod
+    def _align(offset: int) -> int:
+        return (offset + 7) & ~7
+
+    @staticmethod
+    def encode(values: np.ndarray, decimals):
+        """Values as stored for a column with `decimals`, None if they can not be stored that way exactly."""
+        if decimals is None:
+            return values
+        scale = 10 ** decimals
+        present = ~np.isnan(values)
+        with np.errstate(invalid='ignore', over='ignore'):
+            scaled = np.round(values[present] * scale)
+            if not ((np.abs(scaled) <= SCALED_MAX).all() and (scaled / scale == values[present]).all()):
+                return None
+        stored = np.full(len(values), SCALED_NAN, dtype=np.int32)
+        stored[present] = scaled
+        return stored
+
+    @staticmethod
+    def decode(stored: np.ndarray, decimals) -> np.ndarray:
+        if decimals is None:
+            return stored
+        values = stored / 10 ** decimals
+        values[stored == SCALED_NAN] = np.nan
+        return values
+
+    def _header(self, f):
+        """(nrows, capacity, [(name, dtype, decimals)], offset of the first block) of an open file."""
+        preamble = f.read(self.PREAMBLE.size)
+        if len(preamble) < self.PREAMBLE.size:
+            raise ValueError(f"{f.name} is truncated")
+        magic, nrows, capacity, header_len = self.PREAMBLE.unpack(preamble)
+        if magic != self.MAGIC:
+            raise ValueError(f"{f.name} is not a columnar price file")
+        columns = [(name, np.dtype(dtype), decimals) for name, dtype, decimals in json.loads(f.read(header_len))['columns']]
+        return nrows, capacity, columns, self._align(self.PREAMBLE.size + header_len)
+
+    def layout(self, df: pd.DataFrame):
+        """[(name, stored values, decimals)] for the index and every column of `df`."""
+        layout = [(INDEX, _days(df.index), None)]
+        for col in df.columns:
+            values = df[col].to_numpy()
+            if values.dtype.kind not in 'biuf':
+                raise TypeError(f"Column {col!r} of dtype {values.dtype} can not be stored in the columnar format")
+            stored = self.encode(values, SCALED_DECIMALS) if values.dtype.kind == 'f' else None
+            if stored is None:
+                layout.append((col, values, None))
+            else:
+                layout.append((col, stored, SCALED_DECIMALS))
+        return layout
+
+    def read(self, path) -> pd.DataFrame:
+        with open(path, 'rb') as f:
+            nrows, capacity, layout, offset = self._header(f)
+            f.seek(0)
+            raw = np.fromfile(f, dtype=np.uint8)
+        columns = {}
+        for name, dtype, decimals in layout:
+            columns[name] = self.decode(raw[offset:offset + nrows * dtype.itemsize].view(dtype), decimals)
+            offset += capacity * dtype.itemsize
+        if offset > len(raw):
+            raise ValueError(f"{path} is truncated")
+        index = pd.DatetimeIndex(columns.pop(INDEX).astype('datetime64[D]').astype(INDEX_DTYPE), name=INDEX)
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def write(self, path, df: pd.DataFrame, headroom: int = STORAGE_HEADROOM):
+        """Write `df` with `headroom` spare rows. The file is replaced atomically, readers see the old or new one."""
+        nrows = len(df)
+        capacity = nrows + headroom
+        layout = self.layout(df)
+        header = json.dumps({'columns': [[name, values.dtype.str, decimals] for name, values, decimals in layout]})
+        header = header.encode()
+        start = self._align(self.PREAMBLE.size + len(header))
+
+        def write(f):
+            f.write(self.PREAMBLE.pack(self.MAGIC, nrows, capacity, len(header)))
+            f.write(header)
+            f.write(b'\x00' * (start - self.PREAMBLE.size - len(header)))
+            for _, values, _ in layout:
+                f.write(np.ascontiguousarray(values).tobytes())
+                f.write(b'\x00' * ((capacity - nrows) * values.dtype.itemsize))
+        replace_file(path, write)
+
+    def append(self, path, df: pd.DataFrame) -> bool:
+        """
+        Write the rows of `df` into the spare rows of the file, in place.
+        False, with the file untouched, when they do not fit: too few spare rows,
+        other columns, or values the stored dtypes can not hold exactly.
+        """
+        with open(path, 'r+b') as f:
+            nrows, capacity, layout, offset = self._header(f)
+            if nrows + len(df) > capacity or [name for name, _, _ in layout] != [INDEX] + list(df.columns):
+                return False
+            blocks = []
+            arrays = [_days(df.index)] + [df[col].to_numpy() for col in df.columns]
+            for (name, dtype, decimals), values in zip(layout, arrays):
+                values = self.encode(values, decimals)
+                if values is None or not np.can_cast(values.dtype, dtype):
+                    return False
+                blocks.append((offset + nrows * dtype.itemsize, values.astype(dtype)))
+                offset += capacity * dtype.itemsize
+            for position, values in blocks:
+                f.seek(position)
+                f.write(values.tobytes())
+            # Readers only see the new rows once nrows is updated
+            f.flush()
+            f.seek(len(self.MAGIC))
+            f.write(struct.pack('<q', nrows + len(df)))
+        return True
+
+    def spare(self, path) -> int:
+        """Rows that can still be appended in place."""
+        with open(path, 'rb') as f:
+            nrows, capacity, _, _ = self._header(f)
+        return capacity - nrows
+
+    def needs_compaction(self, path) -> bool:
+        return self.spare(path) < STORAGE_HEADROOM // 4
+
+
+STORAGES = {storage.name: storage for storage in (CsvStorage(), ColumnarStorage())}
+
+
+def get_storage(name: str = STORAGE):
+    try:
+        return STORAGES[name]
+    except KeyError:
+        raise ValueError(f"Unknown storage {name!r}, expected one of {list(STORAGES)}")
+
+
+def migrate(data_dir=DATA_DIR, to: str = STORAGE, keep: bool = False):
+    """
+    Convert every price file in `data_dir` to the `to` format.
+    Each file is read back and compared before the original is removed.
+    Returns (files converted, bytes before, bytes after, failures).
+    """
+    target = get_storage(to)
+    converted, before, after, failed = 0, 0, 0, []
+    for source in STORAGES.values():
+        if source is target:
+            continue
+        for path in sorted(data_dir.glob(f'*{source.suffix}')):
+            new_path = path.with_suffix(target.suffix)
+            try:
+                df = source.read(path)
+                target.write(new_path, df)
+                pd.testing.assert_frame_equal(target.read(new_path), df, check_freq=False)
+            except Exception as e:
+                new_path.unlink(missing_ok=True)
+                failed.append((path.name, str(e)))
+                continue
+            converted += 1
+            before += path.stat().st_size
+            after += new_path.stat().st_size
+            if not keep:
+                path.unlink()
+    return converted, before, after, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the stored price files between formats.")
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('--to', choices=list(STORAGES), default=STORAGE, help="Target format (default: config STORAGE)")
+    parser.add_argument('--keep', action='store_true', help="Keep the original files")
+    args = parser.parse_args()
+    converted, before, after, failed = migrate(DATA_DIR, args.to, args.keep)
+    print(f"Converted {converted} files to {args.to}: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    for name, error in failed:
+        print(f"  failed {name}: {error}", file=sys.stderr)
+    if converted:
+        # Imported here, the price cache reads the price files through this module
+        from dataset import publish
+        print(f"Published dataset version {publish()}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
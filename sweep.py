@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Vectorized parameter sweep for the V20 scan.
+
+Evaluates a grid of `history`, `margin`, `filter_by_last_close` and
+`last_close_margin` values in one pass over the data. Green runs come from the
+event index once per stock and history; every margin pair is then a
+broadcast comparison over those events rather than another scan.
+"""
+import argparse
+import sys
+import time
+from typing import List
+import numpy as np
+import pandas as pd
+from algo import get_stock_arrays, window_start, data_version
+from config import STOCKS_FILE
+from events import event_index
+
+COLUMNS = ['history', 'margin', 'filter_by_last_close', 'last_close_margin', 'signals', 'stocks', 'with_buy_date',
+           'mean_profit_margin', 'max_profit_margin']
+
+
+class _Cells:
+    """Running totals for one history over the margin x last_close_margin grid."""
+
+    def __init__(self, n_margins: int, n_close_margins: int):
+        shape = (n_margins, n_close_margins)
+        self.signals = np.zeros(shape, dtype=np.int64)
+        self.stocks = np.zeros(shape, dtype=np.int64)
+        self.with_buy_date = np.zeros(shape, dtype=np.int64)
+        self.profit_sum = np.zeros(shape)
+        self.profit_max = np.full(shape, -np.inf)
+
+    def add(self, passes_margin: np.ndarray, passes_close: np.ndarray, profit: np.ndarray, bought: np.ndarray):
+        """passes_margin is (margins, events), passes_close is (close_margins, events)."""
+        a = passes_margin.astype(np.int64)
+        b = passes_close.astype(np.int64).T
+        signals = a @ b
+        self.signals += signals
+        self.stocks += signals > 0
+        self.with_buy_date += (a * bought) @ b
+        self.profit_sum += (a * profit) @ b
+        both = passes_margin[:, None, :] & passes_close[None, :, :]
+        if both.size:
+            self.profit_max = np.maximum(self.profit_max, np.where(both, profit, -np.inf).max(axis=2))
+
+
+def sweep(symbols: List[str], margins, last_close_margins, histories, filters=(True, False)) -> pd.DataFrame:
+    """
+    Return one row per grid cell with the number of signals, the number of
+    stocks with at least one signal, how many signals already have a buy date,
+    and the mean and max profit_margin of the signals.
+    """
+    margins = np.asarray(sorted(margins), dtype=np.float64)
+    close_margins = np.asarray(sorted(last_close_margins), dtype=np.float64)
+    histories = sorted(histories)
+    filtered = {h: _Cells(len(margins), len(close_margins)) for h in histories}
+    unfiltered = {h: _Cells(len(margins), 1) for h in histories}
+
+    for symbol in symbols:
+        data = get_stock_arrays(symbol)
+        if data is None:
+            continue
+        index = event_index(symbol, data, data_version(symbol))
+        dates = np.asarray(data['Date'], dtype='datetime64[D]')
+        last_close = np.float64(data['Close'][-1])
+        for h in histories:
+            start = window_start(data['MA'], h)
+            if start >= len(dates):
+                continue
+            ev = index.window(data, start)
+            # for catching weird scenarios that will rise with bad data
+            sane = ~(dates[ev['high_idx']] < dates[ev['low_idx']])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                close_margin = 100 * (last_close / ev['low'] - 1)
+                profit = 100 * (ev['high'] / last_close - 1)
+            passes_margin = (ev['v20margin'][None, :] > margins[:, None]) & sane
+            bought = ev['buys'] >= 0
+            filtered[h].add(passes_margin, close_margin[None, :] <= close_margins[:, None], profit, bought)
+            unfiltered[h].add(passes_margin, np.ones((1, len(sane)), dtype=bool), profit, bought)
+
+    rows = []
+    for h in histories:
+        for flag in filters:
+            cells = filtered[h] if flag else unfiltered[h]
+            for i, margin in enumerate(margins):
+                for j, close_margin in enumerate(close_margins):
+                    jj = j if flag else 0
+                    signals = int(cells.signals[i, jj])
+                    rows.append([
+                        h, margin.item(), flag, close_margin.item() if flag else None,
+                        signals, int(cells.stocks[i, jj]), int(cells.with_buy_date[i, jj]),
+                        round(cells.profit_sum[i, jj] / signals, 2) if signals else None,
+                        round(cells.profit_max[i, jj], 2) if signals else None,
+                    ])
+                    if not flag:
+                        # last_close_margin is ignored without the filter
+                        break
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep V20 parameters over a list of stocks.")
+    parser.add_argument('--stocks-file', default=str(STOCKS_FILE), help="File with one symbol per line")
+    parser.add_argument('--histories', type=int, nargs='+', default=[200])
+    parser.add_argument('--margins', type=float, nargs='+', default=[10, 15, 20, 25, 30])
+    parser.add_argument('--last-close-margins', type=float, nargs='+', default=[2, 5, 10])
+    parser.add_argument('--filter-by-last-close', choices=['yes', 'no', 'both'], default='both')
+    parser.add_argument('--out', help="Write the table as CSV to this file instead of printing it")
+    args = parser.parse_args()
+
+    with open(args.stocks_file) as f:
+        symbols = sorted(set(line.strip().upper() for line in f if line.strip()))
+    filters = {'yes': (True,), 'no': (False,), 'both': (True, False)}[args.filter_by_last_close]
+
+    started = time.time()
+    table = sweep(symbols, args.margins, args.last_close_margins, args.histories, filters)
+    if args.out:
+        table.to_csv(args.out, index=False)
+    else:
+        print(table.to_string(index=False))
+    print(f"{len(table)} grid cells over {len(symbols)} stocks in {time.time() - started:.2f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
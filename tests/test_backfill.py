@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from backfill import detect_actions
+from ledger import ACTION_COLUMNS, Ledger
+from trading_calendar import TradingCalendar
+
+
+def bars(rows):
+    return pd.DataFrame({
+        'Symbol': 'ABC',
+        'Date': pd.to_datetime([day for day, _, _ in rows]),
+        'Close': [close for _, close, _ in rows],
+        'PrevClose': [prev_close for _, _, prev_close in rows],
+    })
+
+
+def test_split_on_next_session_is_an_adjustment(tmp_path):
+    calendar = TradingCalendar(tmp_path / 'holidays.json')
+    actions = detect_actions(bars([('2024-01-02', 100.0, 99.0), ('2024-01-03', 52.0, 50.0)]), calendar)
+    assert list(actions['ex_date']) == [pd.Timestamp('2024-01-03')]
+    assert actions['ratio'].iloc[0] == 2.0
+
+
+def test_gap_day_is_not_an_adjustment(tmp_path):
+    calendar = TradingCalendar(tmp_path / 'holidays.json')
+    # No bar for the session of 2024-01-03, PREV_CLOSE of 01-04 is its close
+    actions = detect_actions(bars([('2024-01-01', 104.0, 103.0), ('2024-01-02', 104.0, 104.0),
+                                   ('2024-01-04', 108.0, 107.0)]), calendar)
+    assert actions.empty
+
+
+def test_ledger_keeps_two_actions_on_one_ex_date(tmp_path):
+    ledger = Ledger('ABC', root=tmp_path)
+    raw = pd.DataFrame({'Open': [10.0], 'High': [10.0], 'Low': [10.0], 'Close': [10.0], 'Volume': [100]},
+                       index=pd.DatetimeIndex(['2024-01-02'], name='Date'))
+    split = pd.DataFrame([[pd.Timestamp('2024-03-01'), 'split', 2.0, 'Face Value Split']], columns=ACTION_COLUMNS)
+    bonus = pd.DataFrame([[pd.Timestamp('2024-03-01'), 'bonus', 2.0, 'Bonus 1:1']], columns=ACTION_COLUMNS)
+    assert len(ledger.record(raw, split)) == 1
+    assert len(ledger.record(raw, bonus)) == 1
+    assert len(ledger.record(raw, split)) == 0
+    assert np.isclose(ledger.load_actions()['ratio'].prod(), 4.0)
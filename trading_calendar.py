@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+NSE trading calendar.
+
+The sessions are one sorted datetime64[D] array: weekdays from CALENDAR_START
+to the end of next year, less the exchange holidays. Holidays come from the
+NSE holiday master, cached per year in HOLIDAYS_FILE since NSE only lists the
+current year. Years the cache has never seen fall back to the public holidays
+of the `holidays` package. Every lookup is a binary search of the array.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+from datetime import date, datetime
+import holidays
+import numpy as np
+from config import HOLIDAYS_FILE, HOLIDAYS_MAX_AGE_DAYS
+
+CALENDAR_START = date(2001, 1, 1)
+HOLIDAY_SEGMENT = 'CM'  # Capital market segment of the NSE holiday master
+
+
+def _day(value) -> np.datetime64:
+    return np.datetime64(value, 'D') if not isinstance(value, datetime) else np.datetime64(value.date(), 'D')
+
+
+def _as_date(day: np.datetime64) -> date:
+    return day.astype(object)
+
+
+def parse_nse_holidays(payload: dict, segment: str = HOLIDAY_SEGMENT) -> dict:
+    """Holiday dates by year (ISO strings) from an NSE holiday master payload."""
+    by_year = {}
+    for holiday in payload.get(segment, []):
+        try:
+            day = datetime.strptime(holiday['tradingDate'], '%d-%b-%Y').date()
+        except (KeyError, ValueError):
+            continue
+        by_year.setdefault(str(day.year), set()).add(day.isoformat())
+    return {year: sorted(days) for year, days in by_year.items()}
+
+
+class TradingCalendar:
+    def __init__(self, path=HOLIDAYS_FILE):
+        self.path = path
+        self._sessions = None
+        self._known_years = frozenset()
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def _stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f).get('years', {})
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _build(self, cached: dict):
+        end_year = date.today().year + 1
+        years = range(CALENDAR_START.year, end_year + 1)
+        fallback = holidays.India(years=[year for year in years if str(year) not in cached])
+        closed = [np.datetime64(day, 'D') for day in fallback]
+        closed += [np.datetime64(day, 'D') for days in cached.values() for day in days]
+        all_days = np.arange(np.datetime64(CALENDAR_START, 'D'), np.datetime64(date(end_year + 1, 1, 1), 'D'))
+        return all_days[np.is_busday(all_days, holidays=np.array(closed, dtype='datetime64[D]'))]
+
+    def sessions(self) -> np.ndarray:
+        """All sessions, rebuilt only when the holiday file changed."""
+        key = self._stat_key()
+        if self._sessions is None or key != self._stat:
+            with self._lock:
+                cached = self._read()
+                self._sessions = self._build(cached)
+                self._known_years = frozenset(int(year) for year in cached)
+                self._stat = key
+        return self._sessions
+
+    def known_years(self) -> frozenset:
+        """Years whose holidays come from NSE rather than the fallback."""
+        self.sessions()
+        return self._known_years
+
+    def is_known(self, days: np.ndarray) -> np.ndarray:
+        """Mask of the datetime64[D] `days` that fall in a year with NSE holidays."""
+        years = np.asarray(days, dtype='datetime64[Y]').astype(np.int64) + 1970
+        return np.isin(years, list(self.known_years()))
+
+    def is_session(self, day) -> bool:
+        sessions, day = self.sessions(), _day(day)
+        i = np.searchsorted(sessions, day)
+        return bool(i < len(sessions) and sessions[i] == day)
+
+    def previous_session(self, day) -> date:
+        """Last session strictly before `day`."""
+        sessions = self.sessions()
+        i = int(np.searchsorted(sessions, _day(day), side='left'))
+        if i == 0:
+            raise KeyError(f"No session before {day}")
+        return _as_date(sessions[i - 1])
+
+    def next_session(self, day) -> date:
+        """First session strictly after `day`."""
+        sessions = self.sessions()
+        i = int(np.searchsorted(sessions, _day(day), side='right'))
+        if i == len(sessions):
+            raise KeyError(f"No session after {day}")
+        return _as_date(sessions[i])
+
+    def sessions_between(self, start, end) -> np.ndarray:
+        """Sessions from `start` to `end`, both included, as datetime64[D]."""
+        sessions = self.sessions()
+        return sessions[np.searchsorted(sessions, _day(start), side='left'):
+                        np.searchsorted(sessions, _day(end), side='right')]
+
+    def session_ordinal(self, day) -> int:
+        """Position of `day` among all sessions, KeyError if it is not a session."""
+        sessions, day = self.sessions(), _day(day)
+        i = int(np.searchsorted(sessions, day))
+        if i == len(sessions) or sessions[i] != day:
+            raise KeyError(f"{day} is not a session")
+        return i
+
+    def is_stale(self) -> bool:
+        """The holiday file is missing, lacks the current year or is older than HOLIDAYS_MAX_AGE_DAYS."""
+        key = self._stat_key()
+        if key is None or date.today().year not in self.known_years():
+            return True
+        return (datetime.now().timestamp() - key[0] / 1e9) > HOLIDAYS_MAX_AGE_DAYS * 24 * 60 * 60
+
+    def refresh(self, payload: dict = None) -> dict:
+        """Merge the NSE holiday master into the holiday file. Returns the years it listed."""
+        if payload is None:
+            from api import nse_holidays
+            payload = nse_holidays()
+        fetched = parse_nse_holidays(payload)
+        if not fetched:
+            return {}
+        with self._lock:
+            years = {**self._read(), **fetched}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix='.holidays-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'updated_at': datetime.now().isoformat(timespec='seconds'), 'years': years}, f,
+                              indent=1, sort_keys=True)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return fetched
+
+
+trading_calendar = TradingCalendar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh or query the NSE trading calendar.")
+    parser.add_argument('command', choices=['refresh', 'info', 'previous', 'next'])
+    parser.add_argument('date', nargs='?', help="Date for previous/next (default: today)")
+    args = parser.parse_args()
+    day = date.fromisoformat(args.date) if args.date else date.today()
+    if args.command == 'refresh':
+        for year, days in trading_calendar.refresh().items():
+            print(f"{year}: {len(days)} holidays")
+    elif args.command == 'info':
+        sessions = trading_calendar.sessions()
+        known = ', '.join(str(year) for year in sorted(trading_calendar.known_years())) or "none"
+        print(f"Sessions {len(sessions)} from {sessions[0]} to {sessions[-1]}, NSE holidays for: {known}")
+    elif args.command == 'previous':
+        print(trading_calendar.previous_session(day))
+    else:
+        print(trading_calendar.next_session(day))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())